@@ -0,0 +1,53 @@
+# Startup time of SQLitePersistence loading everything (cache size 0) against loading chats and users lazily,
+# for databases of different sizes. Run from the repository root, with the bot's environment set:
+#   python -m benchmarks.persistence
+import os
+import pickle
+import tempfile
+import time
+
+from bot.persistence import SQLitePersistence
+from bot.repo import Repo
+from bot.repoindex import repo_index
+
+SIZES = [1000, 10000, 100000]
+# In bytes, 0 loads everything at startup
+CACHE_SIZES = [0, 1 << 20]
+
+
+def create(filename, size):
+    # An old single file persistence, which SQLitePersistence migrates on its first load
+    data = {
+        'user_data': {i: {'access_token': 'x' * 40} for i in range(size)},
+        'chat_data': {-i: {'repos': {i: Repo(name=f'owner/{i}', id=i), i + 1: Repo(name=f'owner/{i + 1}', id=i + 1)}}
+                      for i in range(size)},
+        'conversations': {},
+        'github_data': {}
+    }
+    with open(filename, 'wb') as f:
+        pickle.dump(data, f)
+    SQLitePersistence(filename).get_chat_data()
+
+
+def startup(filename, cache_size):
+    start = time.perf_counter()
+    persistence = SQLitePersistence(filename, cache_size=cache_size)
+    persistence.get_user_data()
+    persistence.get_chat_data()
+    return time.perf_counter() - start
+
+
+def main():
+    print('chats/users ' + ' '.join(f'{"cache " + str(cache_size):>14}' for cache_size in CACHE_SIZES))
+    with tempfile.TemporaryDirectory() as directory:
+        for size in SIZES:
+            filename = os.path.join(directory, f'persistence_{size}')
+            create(filename, size)
+            times = [startup(filename, cache_size) for cache_size in CACHE_SIZES]
+            # Either way every subscription has to be in the index
+            assert set(repo_index.chats(size // 2)) == {-(size // 2), -(size // 2 - 1)}
+            print(f'{size:>11} ' + ' '.join(f'{seconds:>12.3f} s' for seconds in times))
+
+
+if __name__ == '__main__':
+    main()
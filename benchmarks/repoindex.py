@@ -0,0 +1,63 @@
+# Finding the chats to notify of an event in a repository with many subscribers: the columnar filter of RepoIndex
+# against the loop over every subscriber's chat_data and Repo object that _send used before.
+# Run from the repository root, with the bot's environment set:
+#   python -m benchmarks.repoindex
+import random
+import time
+
+from bot.const import DEFAULT_TRUNCATION_LIMIT
+from bot.repo import FLAGS, Repo
+from bot.repoindex import RepoIndex
+
+SUBSCRIBERS = [10000, 20000, 100000]
+REPO_ID = 1
+ROUNDS = 50
+
+
+def per_object(index, chat_data):
+    targets = []
+    for chat_id in index.chats(REPO_ID):
+        data = chat_data[chat_id]
+        try:
+            repo = data['repos'][REPO_ID]
+        except KeyError:
+            continue
+        if (lambda r: r.pulls)(repo):
+            targets.append((chat_id, data.get('truncation_limit', DEFAULT_TRUNCATION_LIMIT)))
+    return targets
+
+
+def columnar(index, _):
+    return index.targets(REPO_ID, FLAGS['pulls'])
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        function(*args)
+    return (time.perf_counter() - start) / ROUNDS
+
+
+def main():
+    rng = random.Random(1)
+    print(f'{"subscribers":>11} {"per object":>12} {"columnar":>12} {"after a change":>15}')
+    for subscribers in SUBSCRIBERS:
+        chat_data = {chat_id: {'repos': {REPO_ID: Repo(name='owner/repo', id=REPO_ID, pulls=rng.random() < 0.5)},
+                               'truncation_limit': rng.choice([256, 1024, 4096])}
+                     for chat_id in range(subscribers)}
+        index = RepoIndex()
+        index.rebuild(chat_data)
+        assert sorted(per_object(index, chat_data)) == sorted(columnar(index, chat_data))
+
+        # A subscription changing throws away the cached selectors, which the next event builds again
+        def changed(*args):
+            index.add(REPO_ID, 0, chat_data[0]['repos'][REPO_ID].flags, chat_data[0]['truncation_limit'])
+            return columnar(*args)
+
+        times = [timed(function, index, chat_data) for function in (per_object, columnar, changed)]
+        print(f'{subscribers:>11} ' + ' '.join(f'{seconds * 1000:>{width}.2f} ms'
+                                                for seconds, width in zip(times, (9, 9, 12))))
+
+
+if __name__ == '__main__':
+    main()
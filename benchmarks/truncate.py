@@ -0,0 +1,64 @@
+# Compares cleaning and truncating a notification body the way _send did before it was fed tokens
+# (clean to html, then parse that along with the header, truncated message and suffix) with the way it does now.
+# Counts the html parses of either and times them. Run from the repository root, with the bot's environment set:
+#   python -m benchmarks.truncate
+import time
+from contextlib import contextmanager
+from unittest import mock
+
+from bot import gfm, truncator
+from bot.github import REPLY_MESSAGE, REPLY_MESSAGE_TOKENS, TRUNCATED_MESSAGE, TRUNCATED_MESSAGE_TOKENS
+
+LIMITS = [256, 512, 1024, 2048, 4096]
+HEADER = '🐛 New issue <a href="https://github.com/foo/bar/issues/1">foo/bar#1 Title</a>\nby <a href="x">@x</a>\n\n'
+MARKDOWN = ('## Summary\n\nThis PR **changes** `things` and fixes #12 by @someone.\n\n- [x] done\n- [ ] todo\n\n'
+            '```python\nprint("x" * 10)\n```\n\n> quote\n\n') * 60
+ROUNDS = 20
+
+
+def old(html):
+    cleaned = truncator.github_cleaner.clean(html).strip('\n')
+    return truncator.truncate_many(HEADER + cleaned, TRUNCATED_MESSAGE, REPLY_MESSAGE, LIMITS)
+
+
+def new(html):
+    tokens = truncator.parse_fragment(HEADER) + truncator.clean_tokens(html)
+    return truncator.truncate_many(tokens, TRUNCATED_MESSAGE_TOKENS, REPLY_MESSAGE_TOKENS, LIMITS)
+
+
+@contextmanager
+def count_parses():
+    # Every html parse goes through one of these
+    counts = {'parse': 0}
+
+    def counting(function):
+        def wrapper(*args, **kwargs):
+            counts['parse'] += 1
+            return function(*args, **kwargs)
+        return wrapper
+
+    with mock.patch.object(truncator, 'parse_fragment', counting(truncator.parse_fragment)), \
+            mock.patch.object(truncator, 'clean_tokens', counting(truncator.clean_tokens)), \
+            mock.patch.object(truncator.github_cleaner, 'clean', counting(truncator.github_cleaner.clean)):
+        yield counts
+
+
+def main():
+    html = gfm.render(MARKDOWN, 'foo/bar')
+    print(f'{len(html)} bytes of html, limits {LIMITS}')
+    assert old(html) == new(html)
+
+    for function in (old, new):
+        with count_parses() as counts:
+            function(html)
+
+        start = time.perf_counter()
+        for _ in range(ROUNDS):
+            function(html)
+        elapsed = (time.perf_counter() - start) / ROUNDS
+
+        print(f'{function.__name__}: {counts["parse"]} parses, {elapsed * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+import asyncio
+import json
+import logging
+import time
+from urllib.parse import urlencode, parse_qs
+
+from requests.utils import parse_header_links
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+
+from bot.const import (GITHUB_ASYNC_MAX_CLIENTS, GITHUB_OAUTH_CLIENT_ID, GITHUB_OAUTH_CLIENT_SECRET,
+                       GITHUB_RATE_LIMIT_RETRIES)
+from bot.githubapi import GITHUB_API_ACCEPT, GithubAPI, github_api
+from bot.ratelimit import INTERACTIVE, BACKGROUND
+
+
+def _client_class():
+    # curl keeps connections to github alive between requests, tornado's own client connects for every one
+    try:
+        import pycurl  # noqa: F401
+    except ImportError:
+        return None
+    return 'tornado.curl_httpclient.CurlAsyncHTTPClient'
+
+
+class AsyncGithubAPI:
+    # Non-blocking variant of GithubAPI on tornado's AsyncHTTPClient, sharing the credentials, installation tokens
+    # and rate limits of the blocking one. It runs on the IOLoop of the webhook server. Other threads hand it
+    # coroutines through submit(), so that many calls can be in flight without a thread for every one of them.
+    def __init__(self, sync_api: GithubAPI, max_clients=100):
+        self.logger = logging.getLogger(self.__class__.__qualname__)
+
+        self.sync_api = sync_api
+        self.max_clients = max_clients
+
+        self.io_loop = None
+        self.client = None
+        # installation_id -> asyncio.Lock held while minting its token, the tokens are shared with sync_api
+        self._installation_locks = {}
+
+    def start(self, io_loop):
+        # Has to be called on the thread of io_loop
+        AsyncHTTPClient.configure(_client_class(), max_clients=self.max_clients)
+        self.client = AsyncHTTPClient()
+        self.io_loop = io_loop
+
+    def stop(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+        self.io_loop = None
+
+    def submit(self, coroutine):
+        # From any other thread. Returns a concurrent.futures.Future of the result
+        if self.io_loop is None:
+            coroutine.close()
+            raise RuntimeError('AsyncGithubAPI is not running')
+        return asyncio.run_coroutine_threadsafe(coroutine, self.io_loop.asyncio_loop)
+
+    async def _acquire(self, key, priority):
+        deadline = time.monotonic() + self.sync_api.rate_limiter.max_wait[priority]
+        while True:
+            delay = self.sync_api.rate_limiter.poll(key, priority)
+            if not delay:
+                return
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                # Sent anyway, like GithubAPI does
+                return
+            await asyncio.sleep(min(delay, remaining))
+
+    async def fetch(self, method, url, api=True, jwt_bearer=False, oauth_server_auth=None, access_token=None,
+                    installation_id=None, priority=INTERACTIVE, headers=None, data=None, json_body=None):
+        headers = dict(headers or {})
+        body = None
+        if api:
+            headers.update(GITHUB_API_ACCEPT)
+        if jwt_bearer:
+            headers['Authorization'] = f'Bearer {self.sync_api.jwt_auth.token()}'
+        if installation_id is not None:
+            access_token = await self.get_installation_access_token(installation_id)
+        if access_token:
+            headers['Authorization'] = f'token {access_token}'
+        if oauth_server_auth and (data or json_body):
+            (data or json_body)['client_id'] = GITHUB_OAUTH_CLIENT_ID
+            (data or json_body)['client_secret'] = GITHUB_OAUTH_CLIENT_SECRET
+        if json_body is not None:
+            headers['Content-Type'] = 'application/json'
+            body = json.dumps(json_body)
+        elif data is not None:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            body = urlencode(data)
+        elif method == 'POST':
+            body = ''
+
+        key = GithubAPI._rate_limit_key(jwt_bearer, access_token, oauth_server_auth)
+        request = HTTPRequest(url, method, headers=headers, body=body)
+        for _ in range(GITHUB_RATE_LIMIT_RETRIES + 1):
+            await self._acquire(key, priority)
+            response = await self.client.fetch(request, raise_error=False)
+            if not self.sync_api.rate_limiter.update(key, response.code, response.headers, response.body or b''):
+                break
+        response.rethrow()
+        return response
+
+    async def get_installation_access_token(self, installation_id):
+        tokens = self.sync_api.installation_tokens
+        token = tokens.get(installation_id)
+        if token is not None:
+            return token
+
+        # Only ever used on the IOLoop, so no need to guard it
+        lock = self._installation_locks.get(installation_id)
+        if lock is None:
+            lock = self._installation_locks[installation_id] = asyncio.Lock()
+        async with lock:
+            # Another coroutine may have minted it while this one waited
+            token = tokens.get(installation_id)
+            if token is not None:
+                return token
+
+            r = await self.fetch('POST', f'https://api.github.com/app/installations/{installation_id}/access_tokens',
+                                 jwt_bearer=True)
+
+            return tokens.store(installation_id, json.loads(r.body))
+
+    async def get_paginated(self, key, url, per_page=100, **kwargs):
+        kwargs.setdefault('priority', BACKGROUND)
+        items = []
+        url = f'{url}?{urlencode({"per_page": per_page})}'
+        while url:
+            r = await self.fetch('GET', url, **kwargs)
+            items.extend(json.loads(r.body)[key])
+            links = {link.get('rel'): link['url'] for link in parse_header_links(r.headers.get('Link', ''))}
+            url = links.get('next')
+        return items
+
+    async def get_oauth_access_token(self, code, state):
+        payload = {
+            'client_id': self.sync_api.oauth_client_id,
+            'client_secret': self.sync_api.oauth_client_secret,
+            'code': code,
+            'redirect_uri': self.sync_api.oauth_redirect_uri,
+            'state': state
+        }
+
+        r = await self.fetch('POST', 'https://github.com/login/oauth/access_token', data=payload, api=False)
+
+        return parse_qs(r.body.decode('utf-8'))['access_token'][0]
+
+    async def get_user(self, access_token):
+        r = await self.fetch('GET', 'https://api.github.com/user', access_token=access_token)
+        return json.loads(r.body)
+
+    async def get_installations_for_user(self, access_token):
+        return await self.get_paginated('installations', 'https://api.github.com/user/installations',
+                                        access_token=access_token)
+
+    async def get_repositories_for_installation(self, installation_id, access_token):
+        return await self.get_paginated('repositories',
+                                        f'https://api.github.com/user/installations/{installation_id}/repositories',
+                                        access_token=access_token)
+
+    async def get_repository(self, repo_id, access_token):
+        r = await self.fetch('GET', f'https://api.github.com/repositories/{repo_id}', access_token=access_token)
+        return json.loads(r.body)
+
+    async def markdown(self, markdown, context):
+        r = await self.fetch('POST', 'https://api.github.com/markdown', json_body={
+            'text': markdown,
+            'mode': 'gfm',
+            'context': context
+        }, oauth_server_auth=True, priority=BACKGROUND)
+        return r.body.decode('utf-8')
+
+    async def add_issue_comment(self, repo, number, body, access_token):
+        r = await self.fetch('POST', f'https://api.github.com/repos/{repo}/issues/{number}/comments', json_body={
+            'body': body
+        }, access_token=access_token)
+        return r.body.decode('utf-8')
+
+    async def add_review_comment(self, repo, number, in_reply_to, body, access_token):
+        r = await self.fetch('POST', f'https://api.github.com/repos/{repo}/pulls/{number}/comments', json_body={
+            'body': body,
+            'in_reply_to': in_reply_to
+        }, access_token=access_token)
+        return r.body.decode('utf-8')
+
+
+async_github_api = AsyncGithubAPI(github_api, max_clients=GITHUB_ASYNC_MAX_CLIENTS)
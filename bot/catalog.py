@@ -0,0 +1,166 @@
+import hashlib
+import logging
+import threading
+import time
+from bisect import bisect_left
+from itertools import chain
+
+from bot.cache import LRUCache
+from bot.const import REPO_CATALOG_SIZE, REPO_CATALOG_TTL
+from bot.githubapi import github_api
+from bot.installations import installation_registry
+
+# Keys of a repository that the inline search needs
+_REPOSITORY_KEYS = ('id', 'name', 'full_name', 'html_url')
+
+
+class RepoCatalog:
+    # The repositories a user has access to through installations of the app,
+    # indexed by (lowercase) name and full name so that searching doesn't have to look at each of them
+    def __init__(self, repositories):
+        self.repositories = sorted(repositories, key=lambda repo: repo['full_name'].lower())
+        self._by_id = {repo['id']: repo for repo in self.repositories}
+        # Sorted (key, index in repositories), for finding everything with a prefix by bisecting
+        self._prefixes = sorted([(repo['full_name'].lower(), i) for i, repo in enumerate(self.repositories)] +
+                                [(repo['name'].lower(), i) for i, repo in enumerate(self.repositories)])
+        # One line per repository, to find substrings with str.find
+        self._text = ''.join(f'{repo["full_name"].lower()}\n' for repo in self.repositories)
+        self._line_starts = []
+        position = 0
+        for repo in self.repositories:
+            self._line_starts.append(position)
+            position += len(repo['full_name']) + 1
+
+        self.size = len(self._text) * 8 + len(self.repositories) * 500
+
+    @classmethod
+    def fetch(cls, access_token):
+        repositories = {}
+        user_id = None
+        for installation in github_api.get_installations_for_user(access_token):
+            known = installation_registry.repositories(installation['id'])
+            if known is not None and user_id is None:
+                user_id = github_api.get_user(access_token)['id']
+
+            if known is not None and installation['account']['id'] == user_id:
+                # Installed on the user's own account, so they can see everything the registry knows of.
+                # Other installations can have repositories the user has no access to, so those are still listed.
+                avatar_url = installation['account']['avatar_url']
+                for repo in known:
+                    repositories[repo['id']] = dict({key: repo[key] for key in ('id', 'name', 'full_name')},
+                                                    html_url=f'https://github.com/{repo["full_name"]}',
+                                                    avatar_url=avatar_url)
+                continue
+
+            for repo in github_api.iter_repositories_for_installation(installation['id'], access_token):
+                repositories[repo['id']] = dict({key: repo[key] for key in _REPOSITORY_KEYS},
+                                                avatar_url=repo['owner']['avatar_url'])
+        return cls(repositories.values())
+
+    def repository(self, repo_id):
+        return self._by_id.get(repo_id)
+
+    def _prefix_matches(self, query):
+        for position in range(bisect_left(self._prefixes, (query,)), len(self._prefixes)):
+            key, index = self._prefixes[position]
+            if not key.startswith(query):
+                break
+            yield index
+
+    def _substring_matches(self, query):
+        position = self._text.find(query)
+        while position != -1:
+            index = bisect_left(self._line_starts, position + 1) - 1
+            yield index
+            # On to the next line
+            position = self._text.find(query, self._line_starts[index] + len(self.repositories[index]['full_name']))
+
+    def search(self, query, offset=0, limit=50):
+        # Repositories whose name or full name starts with query first, then those that merely contain it
+        query = query.lower()
+        if not query:
+            return self.repositories[offset:offset + limit]
+
+        results = []
+        seen = set()
+        for index in chain(self._prefix_matches(query), self._substring_matches(query)):
+            if index in seen:
+                continue
+            seen.add(index)
+            if len(seen) > offset:
+                results.append(self.repositories[index])
+                if len(results) >= limit:
+                    break
+        return results
+
+
+class RepoCatalogCache:
+    # Catalogs per access token. Catalogs older than ttl are still used,
+    # but replaced in the background by a fresh one (stale-while-revalidate).
+    def __init__(self, max_bytes, ttl):
+        self.logger = logging.getLogger(self.__class__.__qualname__)
+
+        self.ttl = ttl
+        self.refreshes = 0
+        # Bumped by clear(), so that fetches that started before it don't store outdated catalogs
+        self._generation = 0
+
+        # Hash of access token -> (time fetched, catalog)
+        self._cache = LRUCache(max_bytes, sizeof=lambda item: item[1].size)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(access_token):
+        return hashlib.sha256(access_token.encode('utf-8')).digest()
+
+    def _fetch(self, key, access_token):
+        generation = self._generation
+        catalog = RepoCatalog.fetch(access_token)
+        if generation == self._generation:
+            self._cache.set(key, (time.monotonic(), catalog))
+        return catalog
+
+    def _refresh(self, key, access_token):
+        try:
+            self._fetch(key, access_token)
+            self.refreshes += 1
+        except Exception:
+            self.logger.warning('Error while refreshing repository catalog', exc_info=1)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def get(self, access_token):
+        key = self._key(access_token)
+        cached = self._cache.get(key)
+        if cached is None:
+            return self._fetch(key, access_token)
+
+        fetched, catalog = cached
+        if time.monotonic() - fetched > self.ttl:
+            with self._lock:
+                refresh = key not in self._refreshing
+                self._refreshing.add(key)
+            if refresh:
+                threading.Thread(target=self._refresh, args=(key, access_token), daemon=True,
+                                 name='repo_catalog_refresh').start()
+        return catalog
+
+    def peek(self, access_token):
+        # The cached catalog, however old, without fetching anything
+        cached = self._cache.get(self._key(access_token))
+        return cached[1] if cached is not None else None
+
+    def invalidate(self, access_token):
+        self._cache.delete(self._key(access_token))
+
+    def clear(self):
+        self._generation += 1
+        self._cache.clear()
+
+    def stats(self):
+        return dict(self._cache.stats(), refreshes=self.refreshes)
+
+
+repo_catalogs = RepoCatalogCache(REPO_CATALOG_SIZE, REPO_CATALOG_TTL)
@@ -15,3 +15,62 @@ GITHUB_OAUTH_CLIENT_SECRET = os.getenv('GITHUB_OAUTH_CLIENT_SECRET')
 GITHUB_OAUTH_REDIRECT_URI = SERVER_URL_BASE + '/github/auth'
 DEBUG = os.getenv('DEBUG', False)
 DEFAULT_TRUNCATION_LIMIT = 4096
+MARKDOWN_CACHE_SIZE = int(os.getenv('MARKDOWN_CACHE_SIZE', 8 * 1024 * 1024))
+MARKDOWN_CACHE_TTL = int(os.getenv('MARKDOWN_CACHE_TTL', 60 * 60))
+# One of api, local, fallback (api, local on errors) or shadow (api, compared with local)
+MARKDOWN_RENDERER = os.getenv('MARKDOWN_RENDERER', 'api')
+SEND_WORKERS = int(os.getenv('SEND_WORKERS', 8))
+# Telegram allows about 30 messages per second overall and 1 per second per chat
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', 30))
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', 1))
+# html5lib, htmlparser (faster) or differential (html5lib, checked against htmlparser)
+TRUNCATOR_ENGINE = os.getenv('TRUNCATOR_ENGINE', 'html5lib')
+# Processes that clean and truncate markdown. 0 renders in the calling thread
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', 0))
+RENDER_MAX_IN_FLIGHT = int(os.getenv('RENDER_MAX_IN_FLIGHT', 2 * RENDER_WORKERS))
+# Threads handling github updates, and how many updates for a single repository may be queued
+# (more are left in the webhook journal and taken from there again once there is room)
+GITHUB_WORKERS = int(os.getenv('GITHUB_WORKERS', 4))
+GITHUB_QUEUE_SIZE = int(os.getenv('GITHUB_QUEUE_SIZE', 100))
+WEBHOOK_JOURNAL_FILE = os.getenv('WEBHOOK_JOURNAL_FILE', f'{DATABASE_FILE}.journal')
+# How long handled deliveries are kept in the journal
+WEBHOOK_JOURNAL_RETENTION = int(os.getenv('WEBHOOK_JOURNAL_RETENTION', 24 * 60 * 60))
+# Redeliveries of a github delivery seen within this many seconds are ignored.
+# Should not be longer than WEBHOOK_JOURNAL_RETENTION, since that is where they are remembered across restarts
+WEBHOOK_DEDUP_WINDOW = int(os.getenv('WEBHOOK_DEDUP_WINDOW', 24 * 60 * 60))
+WEBHOOK_DEDUP_SIZE = int(os.getenv('WEBHOOK_DEDUP_SIZE', 100000))
+# sqlite (only writes what changed, migrates an old pickle database) or pickle
+PERSISTENCE_BACKEND = os.getenv('PERSISTENCE_BACKEND', 'sqlite')
+# Bytes of user and chat data the sqlite persistence keeps in memory, loading the rest when needed.
+# 0 loads everything on startup
+PERSISTENCE_CACHE_SIZE = int(os.getenv('PERSISTENCE_CACHE_SIZE', 0))
+# How many pages of a paginated github api response are fetched at once
+GITHUB_PAGINATION_WORKERS = int(os.getenv('GITHUB_PAGINATION_WORKERS', 4))
+# Bytes of repository catalogs (what the "Add repository" inline query searches) kept in memory,
+# and after how many seconds a catalog is refreshed in the background
+REPO_CATALOG_SIZE = int(os.getenv('REPO_CATALOG_SIZE', 16 * 1024 * 1024))
+REPO_CATALOG_TTL = int(os.getenv('REPO_CATALOG_TTL', 5 * 60))
+# How many github user profiles (shown in the settings menus) are kept, and for how many seconds before revalidating
+GITHUB_USER_CACHE_SIZE = int(os.getenv('GITHUB_USER_CACHE_SIZE', 10000))
+GITHUB_USER_CACHE_TTL = int(os.getenv('GITHUB_USER_CACHE_TTL', 60))
+# Bytes of github api responses kept for CacheControl, and optionally a file to keep them in across restarts
+GITHUB_HTTP_CACHE_SIZE = int(os.getenv('GITHUB_HTTP_CACHE_SIZE', 32 * 1024 * 1024))
+GITHUB_HTTP_CACHE_FILE = os.getenv('GITHUB_HTTP_CACHE_FILE', '')
+# Github api calls left before a rate limit reset that are kept for interactive calls (menus, replies)
+GITHUB_RATE_LIMIT_RESERVE = int(os.getenv('GITHUB_RATE_LIMIT_RESERVE', 100))
+# How often a rate limited call is retried, and how many seconds interactive and background calls
+# wait for the rate limit at most before being sent anyway
+GITHUB_RATE_LIMIT_RETRIES = int(os.getenv('GITHUB_RATE_LIMIT_RETRIES', 3))
+GITHUB_INTERACTIVE_MAX_WAIT = int(os.getenv('GITHUB_INTERACTIVE_MAX_WAIT', 10))
+GITHUB_BACKGROUND_MAX_WAIT = int(os.getenv('GITHUB_BACKGROUND_MAX_WAIT', 5 * 60))
+# Github api calls the async client makes at once
+GITHUB_ASYNC_MAX_CLIENTS = int(os.getenv('GITHUB_ASYNC_MAX_CLIENTS', 100))
+# single handles everything in one process. split leaves the webhook server, telegram updates and
+# deliveries without a repository to this process, and handles the other github deliveries in DELIVERY_WORKERS
+# processes that take them from the webhook journal. Needs the sqlite persistence.
+PROCESS_MODE = os.getenv('PROCESS_MODE', 'single')
+DELIVERY_WORKERS = int(os.getenv('DELIVERY_WORKERS', 2))
+# Seconds between delivery workers looking for new deliveries when idle,
+# and between looking for deferred deliveries that fit in the queue again
+DELIVERY_POLL_INTERVAL = float(os.getenv('DELIVERY_POLL_INTERVAL', 0.05))
+DELIVERY_SUBSCRIPTIONS_REFRESH = int(os.getenv('DELIVERY_SUBSCRIPTIONS_REFRESH', 30))
@@ -0,0 +1,64 @@
+import threading
+import time
+from collections import OrderedDict
+
+from bot.const import WEBHOOK_DEDUP_SIZE, WEBHOOK_DEDUP_WINDOW
+
+
+class DeliveryDedup:
+    # Remembers the ids of recent github deliveries (at most max_size of them, for at most window seconds),
+    # so that redeliveries of something already handled can be ignored
+    def __init__(self, window, max_size):
+        self.window = window
+        self.max_size = max_size
+
+        self.duplicates = 0
+
+        # guid -> time first seen, oldest first
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        while self._seen:
+            guid, seen_at = next(iter(self._seen.items()))
+            if seen_at >= now - self.window and len(self._seen) <= self.max_size:
+                break
+            del self._seen[guid]
+
+    def check(self, guid):
+        # Returns whether guid is a duplicate, and remembers it if it isn't
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            if guid in self._seen:
+                self.duplicates += 1
+                return True
+            self._seen[guid] = now
+            self._expire(now)
+            return False
+
+    def forget(self, guid):
+        with self._lock:
+            self._seen.pop(guid, None)
+
+    def load(self, seen):
+        # Takes (guid, time seen) pairs, oldest first
+        now = time.time()
+        with self._lock:
+            for guid, seen_at in seen:
+                if seen_at >= now - self.window:
+                    self._seen.setdefault(guid, seen_at)
+            self._expire(now)
+
+    def __len__(self):
+        return len(self._seen)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'remembered': len(self._seen),
+                'duplicates': self.duplicates
+            }
+
+
+delivery_dedup = DeliveryDedup(WEBHOOK_DEDUP_WINDOW, WEBHOOK_DEDUP_SIZE)
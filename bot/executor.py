@@ -0,0 +1,119 @@
+import logging
+import threading
+import time
+from collections import deque
+
+
+class KeyedExecutor:
+    # Runs jobs on a pool of threads. Jobs with different keys run concurrently,
+    # jobs with the same key run one at a time in the order they were submitted.
+    def __init__(self, workers=4, max_queue=100):
+        self.logger = logging.getLogger(self.__class__.__qualname__)
+
+        self.workers = workers
+        self.max_queue = max_queue
+
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_lag = 0.0
+
+        # key -> pending (submitted_at, fn, args). A key is in here iff it is either ready or being run
+        self._queues = {}
+        # Keys waiting on a worker
+        self._ready = deque()
+        self._cond = threading.Condition()
+        self._threads = []
+        self.running = False
+
+    def start(self):
+        self.running = True
+        for i in range(self.workers):
+            thr = threading.Thread(target=self._worker, name=f'keyed_executor_{i}', daemon=True)
+            thr.start()
+            self._threads.append(thr)
+
+    def stop(self):
+        with self._cond:
+            self.running = False
+            self._cond.notify_all()
+        for thr in self._threads:
+            thr.join()
+        self._threads = []
+
+        pending = sum(len(queue) for queue in self._queues.values())
+        if pending:
+            self.logger.warning('Stopped with %d jobs still pending', pending)
+
+    def submit(self, key, fn, *args):
+        # Returns whether the job was queued. A single busy key mustn't grow without bounds, but the submitter
+        # (e.g. the dispatcher thread) mustn't be held up by it either, so a full queue rejects the job
+        with self._cond:
+            queue = self._queues.get(key)
+            if queue is not None and len(queue) >= self.max_queue:
+                self.rejected += 1
+                return False
+
+            if queue is None:
+                queue = self._queues[key] = deque()
+                self._ready.append(key)
+                self._cond.notify_all()
+            queue.append((time.monotonic(), fn, args))
+            return True
+
+    def _next(self):
+        with self._cond:
+            while self.running:
+                if self._ready:
+                    key = self._ready.popleft()
+                    return key, self._queues[key][0]
+                self._cond.wait()
+
+    def _worker(self):
+        while True:
+            job = self._next()
+            if job is None:
+                return
+            key, (submitted_at, fn, args) = job
+
+            lag = time.monotonic() - submitted_at
+            failed = False
+            try:
+                fn(*args)
+            except Exception:
+                failed = True
+                self.logger.exception('Error while running job for %r', key)
+
+            with self._cond:
+                self.max_lag = max(self.max_lag, lag)
+                if failed:
+                    self.failed += 1
+                else:
+                    self.completed += 1
+
+                queue = self._queues[key]
+                queue.popleft()
+                if queue:
+                    self._ready.append(key)
+                else:
+                    del self._queues[key]
+                self._cond.notify_all()
+
+    def lag(self):
+        # key -> (pending jobs including the running one, seconds since the oldest of them was submitted)
+        now = time.monotonic()
+        with self._cond:
+            return {key: (len(queue), now - queue[0][0]) for key, queue in self._queues.items()}
+
+    def stats(self):
+        lag = self.lag()
+        with self._cond:
+            return {
+                'pending': sum(pending for pending, _ in lag.values()),
+                'keys': len(lag),
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'current_lag': max((seconds for _, seconds in lag.values()), default=0.0),
+                'max_lag': self.max_lag
+            }
@@ -0,0 +1,116 @@
+from html.parser import HTMLParser
+from urllib.parse import urlparse
+
+from bleach.html5lib_shim import HTML_TAGS_BLOCK_LEVEL
+from bleach.sanitizer import INVISIBLE_CHARACTERS_RE, INVISIBLE_REPLACEMENT_CHAR
+from html5lib.constants import namespaces, voidElements
+from html5lib.filters.base import Filter
+
+# A tokenizer built on the stdlib html.parser that produces the same tokens as walking a html5lib parse tree,
+# for html that is already well-formed (like what the GitHub API and bleach return).
+# It only mimics the parts of html5lib's tree construction that such html needs.
+
+_NAMESPACE = namespaces['html']
+
+
+class _Tokenizer(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.tokens = []
+        self.open_tags = []
+
+    def _attributes(self, attrs):
+        data = {}
+        for name, value in attrs:
+            # The first occurrence of an attribute wins, like in html5lib
+            data.setdefault((None, name), value if value is not None else '')
+        return data
+
+    def handle_starttag(self, tag, attrs):
+        if tag in voidElements:
+            self.tokens.append({'type': 'EmptyTag', 'name': tag, 'namespace': _NAMESPACE,
+                                'data': self._attributes(attrs)})
+        else:
+            self.tokens.append({'type': 'StartTag', 'name': tag, 'namespace': _NAMESPACE,
+                                'data': self._attributes(attrs)})
+            self.open_tags.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        # html ignores the self-closing flag on non-void elements
+        self.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if tag not in self.open_tags:
+            return
+        while self.open_tags:
+            name = self.open_tags.pop()
+            self.tokens.append({'type': 'EndTag', 'name': name, 'namespace': _NAMESPACE})
+            if name == tag:
+                break
+
+    def handle_data(self, data):
+        previous = self.tokens[-1] if self.tokens else None
+        if (previous and previous['type'] == 'StartTag' and previous['name'] in ('pre', 'listing', 'textarea')
+                and data.startswith('\n')):
+            data = data[1:]
+        if not data:
+            return
+        if previous and previous['type'] == 'Characters':
+            previous['data'] += data
+        else:
+            self.tokens.append({'type': 'Characters', 'data': data})
+
+    def handle_comment(self, data):
+        self.tokens.append({'type': 'Comment', 'data': data})
+
+    def close(self):
+        super().close()
+        while self.open_tags:
+            self.tokens.append({'type': 'EndTag', 'name': self.open_tags.pop(), 'namespace': _NAMESPACE})
+
+
+def parse_fragment(html):
+    tokenizer = _Tokenizer()
+    tokenizer.feed(html)
+    tokenizer.close()
+    return tokenizer.tokens
+
+
+class SanitizerFilter(Filter):
+    # The subset of bleach's sanitizer that github_cleaner uses: strip disallowed tags (keeping their text,
+    # and a newline for block level ones), attributes and comments, drop links with disallowed protocols
+    # and replace invisible characters.
+    def __init__(self, source, tags, attributes, protocols):
+        super().__init__(source)
+        self.tags = frozenset(tags)
+        self.attributes = attributes
+        self.protocols = frozenset(protocols)
+
+    def _allowed_value(self, name, value):
+        if name not in ('href', 'src'):
+            return True
+        scheme = urlparse(value.strip()).scheme.lower()
+        return not scheme or scheme in self.protocols
+
+    def __iter__(self):
+        first = True
+        for token in super().__iter__():
+            was_first, first = first, False
+            if token['type'] in ('StartTag', 'EndTag', 'EmptyTag'):
+                if token['name'] not in self.tags:
+                    if token['type'] == 'StartTag' and token['name'] in HTML_TAGS_BLOCK_LEVEL and not was_first:
+                        yield {'type': 'Characters', 'data': '\n'}
+                    continue
+                if token['type'] != 'EndTag':
+                    allowed = self.attributes.get(token['name'], ())
+                    token['data'] = {(namespace, name): value
+                                     for (namespace, name), value in token['data'].items()
+                                     if namespace is None and name in allowed and self._allowed_value(name, value)}
+                yield token
+            elif token['type'] == 'Comment':
+                continue
+            elif token['type'] == 'Characters':
+                token['data'] = INVISIBLE_CHARACTERS_RE.sub(INVISIBLE_REPLACEMENT_CHAR, token['data'])
+                yield token
+            else:
+                yield token
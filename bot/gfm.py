@@ -0,0 +1,407 @@
+import re
+from html import escape, unescape
+from html.entities import html5
+
+# A small in-process GitHub flavored markdown renderer.
+# It does not aim to implement the whole spec, only to produce html close enough to what
+# https://api.github.com/markdown returns that it comes out the same after github_cleaner.
+
+_FENCE_RE = re.compile(r'^( {0,3})(`{3,}|~{3,})\s*([^`\s]*)[^`]*$')
+_HR_RE = re.compile(r'^ {0,3}([-*_])(?:[ \t]*\1){2,}[ \t]*$')
+_HEADING_RE = re.compile(r'^ {0,3}(#{1,6})(?:[ \t]+(.*?))?(?:[ \t]+#+)?[ \t]*$')
+_SETEXT_RE = re.compile(r'^ {0,3}(=+|-+)[ \t]*$')
+_QUOTE_RE = re.compile(r'^ {0,3}> ?')
+_LIST_RE = re.compile(r'^( {0,3})([-+*]|\d{1,9}[.)])([ \t]+|$)')
+_TASK_RE = re.compile(r'^\[([ xX])\](?=\s)')
+_HTML_BLOCK_RE = re.compile(r'^ {0,3}</?[A-Za-z][A-Za-z0-9-]*(?:\s[^>]*)?/?>')
+_INDENTED_RE = re.compile(r'^(?: {4}|\t)')
+
+_CODE_SPAN_RE = re.compile(r'(`+)(.+?)(?<!`)\1(?!`)', re.S)
+_BACKSLASH_RE = re.compile(r'\\([!"#$%&\'()*+,\-./:;<=>?@\[\\\]^_`{|}~])')
+_AUTOLINK_RE = re.compile(r'<((?:https?|ftp)://[^\s<>]+|[^\s<>@]+@[^\s<>@]+\.[^\s<>@]+)>')
+_INLINE_HTML_RE = re.compile(r'</?[A-Za-z][A-Za-z0-9-]*(?:\s+[A-Za-z_:][\w:.-]*(?:\s*=\s*(?:"[^"]*"|\'[^\']*\'|[^\s"\'=<>`]+))?)*\s*/?>')
+_LINK_RE = re.compile(r'(!?)\[((?:[^\[\]]|\[[^\[\]]*\])*)\]\(\s*<?([^\s()<>]*(?:\([^\s()<>]*\)[^\s()<>]*)*)>?(?:\s+"([^"]*)")?\s*\)')
+_BARE_URL_RE = re.compile(r'(?<![\w/])((?:https?://|www\.)(?:(?!&lt;)[^\s<])*(?!&lt;)[^\s<?!.,:*_~)\'"])')
+_MENTION_RE = re.compile(r'(?<![\w@/`])@([A-Za-z0-9](?:-?[A-Za-z0-9]){0,38})(?![\w/])')
+_ENTITY_RE = re.compile(r'&(?:#[0-9]{1,7}|#[xX][0-9a-fA-F]{1,6}|[A-Za-z][A-Za-z0-9]{1,31});')
+_ISSUE_RE = re.compile(r'(?<![\w&/#])#(\d+)\b')
+_DELIMITER_RE = re.compile(r'\*+|_+|~+')
+_PLACEHOLDER_RE = re.compile('\x00(\\d+)\x00')
+
+# Deeper blockquotes and lists are left as text, each level is a recursion
+_MAX_NESTING = 32
+
+
+def _is_block_start(line):
+    return bool(_FENCE_RE.match(line) or _HR_RE.match(line) or _HEADING_RE.match(line) or
+                _QUOTE_RE.match(line) or _HTML_BLOCK_RE.match(line))
+
+
+def _interrupts_paragraph(line):
+    if _is_block_start(line):
+        return True
+    match = _LIST_RE.match(line)
+    # Only bullet lists and lists starting at 1 may interrupt a paragraph
+    return bool(match and match.group(3) and match.group(2)[:-1] in ('', '1'))
+
+
+def _expand_tabs(line):
+    return line.expandtabs(4) if '\t' in line else line
+
+
+class _Delimiter:
+    # A run of *, _ or ~ that may open or close emphasis
+    __slots__ = ('start', 'end', 'char', 'count', 'opens', 'closes')
+
+    def __init__(self, start, end, char):
+        self.start = start
+        self.end = end
+        self.char = char
+        self.count = end - start
+        # Tags in the order they were matched, innermost first
+        self.opens = []
+        self.closes = []
+
+
+class _InlineRenderer:
+    def __init__(self, context):
+        self.context = context
+        self.stash = []
+
+    def _stash(self, html):
+        self.stash.append(html)
+        return f'\x00{len(self.stash) - 1}\x00'
+
+    def _unstash(self, text):
+        while '\x00' in text:
+            text = _PLACEHOLDER_RE.sub(lambda m: self.stash[int(m.group(1))], text)
+        return text
+
+    def _code_span(self, match):
+        code = match.group(2).replace('\n', ' ')
+        if code.startswith(' ') and code.endswith(' ') and code.strip():
+            code = code[1:-1]
+        return self._stash(f'<code>{escape(code, quote=False)}</code>')
+
+    def _autolink(self, match):
+        url = match.group(1)
+        href = url if '://' in url else f'mailto:{url}'
+        return self._stash(f'<a href="{escape(href)}">{escape(url, quote=False)}</a>')
+
+    def _entity(self, match):
+        reference = match.group(0)
+        if reference[1] != '#' and reference[1:] not in html5:
+            # Not an entity, so just text
+            return reference
+        return self._stash(escape(unescape(reference), quote=False))
+
+    def _link(self, match):
+        image, text, url, title = match.groups()
+        # Entities and backslash escapes in the url were stashed in their escaped form already
+        href = escape(unescape(self._unstash(url)))
+        if image:
+            return self._stash(f'<a href="{href}"><img src="{href}" alt="{escape(text)}"></a>')
+        return self._stash(f'<a href="{href}">{self._emphasis(self._escape(text))}</a>')
+
+    def _bare_url(self, match):
+        url = match.group(1)
+        # Don't swallow a closing parenthesis that has no matching opening one
+        while url.endswith(')') and url.count(')') > url.count('('):
+            url = url[:-1]
+        href = url if '://' in url else f'http://{url}'
+        # The text has been escaped for outside of attributes, quotes were left as they are
+        return self._stash(f'<a href="{escape(unescape(self._unstash(href)))}">{url}</a>') + match.group(1)[len(url):]
+
+    def _mention(self, match):
+        login = match.group(1)
+        return self._stash(f'<a class="user-mention" href="https://github.com/{login}">@{login}</a>')
+
+    def _issue(self, match):
+        number = match.group(1)
+        return self._stash(f'<a class="issue-link" href="https://github.com/{self.context}/issues/{number}">'
+                           f'#{number}</a>')
+
+    def _escape(self, text):
+        # Everything that must not be escaped has already been stashed away
+        return escape(text, quote=False)
+
+    def _emphasis(self, text):
+        # Pairs up delimiter runs in one pass with a stack per character, like the spec's delimiter stack,
+        # instead of regexes that would search the rest of the text for a closer from every opener
+        runs = []
+        stacks = {'*': [], '_': [], '~': []}
+        for match in _DELIMITER_RE.finditer(text):
+            run = _Delimiter(match.start(), match.end(), match.group()[0])
+            if run.char == '~' and run.count != 2:
+                continue
+            before = text[run.start - 1] if run.start else ' '
+            after = text[run.end] if run.end < len(text) else ' '
+            can_open = not after.isspace()
+            can_close = not before.isspace()
+            if run.char == '_':
+                # No intraword emphasis with underscores
+                can_open = can_open and not before.isalnum()
+                can_close = can_close and not after.isalnum()
+            runs.append(run)
+
+            stack = stacks[run.char]
+            while can_close and stack and run.count:
+                opener = stack[-1]
+                # Runs opened inside this one can't be closed anymore
+                for other in stacks.values():
+                    while other and other[-1].start > opener.start:
+                        other.pop()
+                used = 2 if run.char == '~' or (opener.count >= 2 and run.count >= 2) else 1
+                tag = 'del' if run.char == '~' else 'strong' if used == 2 else 'em'
+                opener.count -= used
+                run.count -= used
+                opener.opens.append(f'<{tag}>')
+                run.closes.append(f'</{tag}>')
+                if not opener.count:
+                    stack.pop()
+            if can_open and run.count:
+                stack.append(run)
+
+        out = []
+        position = 0
+        for run in runs:
+            out.append(text[position:run.start])
+            out.append(''.join(run.closes) + run.char * run.count + ''.join(reversed(run.opens)))
+            position = run.end
+        out.append(text[position:])
+        return ''.join(out)
+
+    def render(self, text):
+        text = _CODE_SPAN_RE.sub(self._code_span, text)
+        text = _BACKSLASH_RE.sub(lambda m: self._stash(escape(m.group(1))), text)
+        text = _AUTOLINK_RE.sub(self._autolink, text)
+        text = _ENTITY_RE.sub(self._entity, text)
+        text = _INLINE_HTML_RE.sub(lambda m: self._stash(m.group(0)), text)
+        text = _LINK_RE.sub(self._link, text)
+        text = self._escape(text)
+        text = _BARE_URL_RE.sub(self._bare_url, text)
+        text = _MENTION_RE.sub(self._mention, text)
+        if self.context:
+            text = _ISSUE_RE.sub(self._issue, text)
+        text = self._emphasis(text)
+        # Line breaks are hard in gfm mode
+        text = re.sub(r'(?: {2,}|\\)?\n', '<br>\n', text.strip())
+        return self._unstash(text)
+
+
+class _BlockParser:
+    def __init__(self, context):
+        self.context = context
+        self.depth = 0
+
+    def inline(self, text):
+        return _InlineRenderer(self.context).render(text)
+
+    def parse(self, lines):
+        out = []
+        i = 0
+        while i < len(lines):
+            line = lines[i]
+
+            if not line.strip():
+                i += 1
+                continue
+
+            match = _FENCE_RE.match(line)
+            if match:
+                i = self._fence(lines, i, match, out)
+                continue
+
+            if _HR_RE.match(line):
+                out.append('<hr>')
+                i += 1
+                continue
+
+            match = _HEADING_RE.match(line)
+            if match:
+                level = len(match.group(1))
+                out.append(f'<h{level}>{self.inline(match.group(2) or "")}</h{level}>')
+                i += 1
+                continue
+
+            nested = self.depth < _MAX_NESTING
+            if nested and _QUOTE_RE.match(line):
+                i = self._blockquote(lines, i, out)
+                continue
+
+            match = nested and _LIST_RE.match(line)
+            if match:
+                i = self._list(lines, i, out)
+                continue
+
+            if _INDENTED_RE.match(line):
+                i = self._indented_code(lines, i, out)
+                continue
+
+            if _HTML_BLOCK_RE.match(line):
+                start = i
+                while i < len(lines) and lines[i].strip():
+                    i += 1
+                out.append('\n'.join(lines[start:i]))
+                continue
+
+            i = self._paragraph(lines, i, out)
+
+        return out
+
+    def _parse_nested(self, lines):
+        self.depth += 1
+        try:
+            return self.parse(lines)
+        finally:
+            self.depth -= 1
+
+    def _fence(self, lines, i, match, out):
+        indent, fence, lang = len(match.group(1)), match.group(2), match.group(3)
+        code = []
+        i += 1
+        while i < len(lines):
+            closing = re.match(r'^ {0,3}(' + re.escape(fence[0]) + r'{' + str(len(fence)) + r',})[ \t]*$', lines[i])
+            if closing:
+                i += 1
+                break
+            code.append(re.sub(r'^ {0,%d}' % indent, '', lines[i]))
+            i += 1
+        lang_attr = f' lang="{escape(lang)}"' if lang else ''
+        body = escape('\n'.join(code) + '\n' if code else '', quote=False)
+        out.append(f'<pre{lang_attr}><code>{body}</code></pre>')
+        return i
+
+    def _indented_code(self, lines, i, out):
+        code = []
+        while i < len(lines) and (_INDENTED_RE.match(lines[i]) or not lines[i].strip()):
+            code.append(_expand_tabs(lines[i])[4:])
+            i += 1
+        while code and not code[-1].strip():
+            code.pop()
+        out.append(f'<pre><code>{escape(chr(10).join(code) + chr(10), quote=False)}</code></pre>')
+        return i
+
+    def _blockquote(self, lines, i, out):
+        inner = []
+        while i < len(lines):
+            match = _QUOTE_RE.match(lines[i])
+            if match:
+                inner.append(lines[i][match.end():])
+            elif lines[i].strip() and inner and inner[-1].strip() and not _interrupts_paragraph(lines[i]):
+                # Lazy continuation of a paragraph inside the quote
+                inner.append(lines[i])
+            else:
+                break
+            i += 1
+        out.append('<blockquote>\n' + '\n'.join(self._parse_nested(inner)) + '\n</blockquote>')
+        return i
+
+    def _list(self, lines, i, out):
+        first = _LIST_RE.match(lines[i])
+        ordered = first.group(2)[-1] in '.)'
+        marker = first.group(2)[-1]
+
+        items = []
+        loose = False
+        while i < len(lines):
+            match = _LIST_RE.match(lines[i])
+            if not match or (match.group(2)[-1] in '.)') != ordered or match.group(2)[-1] != marker:
+                break
+
+            content_indent = len(match.group(0)) if match.group(3) else len(match.group(0)) + 1
+            if len(match.group(3)) > 4:
+                content_indent = len(match.group(1)) + len(match.group(2)) + 1
+            item = [lines[i][content_indent:] if len(lines[i]) > content_indent else lines[i][match.end():]]
+            i += 1
+
+            while i < len(lines):
+                line = _expand_tabs(lines[i])
+                if not line.strip():
+                    # A blank line only continues the item if indented content follows it
+                    j = i
+                    while j < len(lines) and not lines[j].strip():
+                        j += 1
+                    if j < len(lines) and len(lines[j]) - len(lines[j].lstrip(' ')) >= content_indent:
+                        item.extend([''] * (j - i))
+                        i = j
+                        continue
+                    break
+                if len(line) - len(line.lstrip(' ')) >= content_indent:
+                    item.append(line[content_indent:])
+                elif item[-1].strip() and not _interrupts_paragraph(line) and not _LIST_RE.match(line):
+                    item.append(line)
+                else:
+                    break
+                i += 1
+
+            items.append(item)
+
+            # Blank lines between items make the list loose
+            if i < len(lines) and not lines[i].strip():
+                j = i
+                while j < len(lines) and not lines[j].strip():
+                    j += 1
+                next_match = _LIST_RE.match(lines[j]) if j < len(lines) else None
+                if next_match and next_match.group(2)[-1] == marker:
+                    loose = True
+                    i = j
+                else:
+                    break
+            if any(not line.strip() for line in item[:-1]):
+                loose = True
+
+        rendered = []
+        task_list = False
+        for item in items:
+            attrs = ''
+            checkbox = ''
+            task = _TASK_RE.match(item[0])
+            if task:
+                task_list = True
+                attrs = ' class="task-list-item"'
+                checked = ' checked=""' if task.group(1) in 'xX' else ''
+                checkbox = f'<input type="checkbox" class="task-list-item-checkbox" disabled=""{checked}> '
+                item = [item[0][task.end():].lstrip()] + item[1:]
+
+            blocks = self._parse_nested(item)
+            if not loose:
+                blocks = [block[3:-4] if block.startswith('<p>') and block.endswith('</p>') else block
+                          for block in blocks]
+                inner = '\n'.join(blocks) + ('\n' if len(blocks) > 1 else '')
+            else:
+                inner = '\n' + '\n'.join(blocks) + '\n'
+            rendered.append(f'<li{attrs}>{checkbox}{inner}</li>')
+
+        tag = 'ol' if ordered else 'ul'
+        start = ''
+        if ordered and first.group(2)[:-1] != '1':
+            start = f' start="{int(first.group(2)[:-1])}"'
+        list_attrs = ' class="contains-task-list"' if task_list else ''
+        out.append(f'<{tag}{start}{list_attrs}>\n' + '\n'.join(rendered) + f'\n</{tag}>')
+        return i
+
+    def _paragraph(self, lines, i, out):
+        paragraph = [lines[i].strip()]
+        i += 1
+        while i < len(lines) and lines[i].strip():
+            line = lines[i]
+            setext = _SETEXT_RE.match(line)
+            if setext:
+                level = 1 if setext.group(1)[0] == '=' else 2
+                out.append(f'<h{level}>{self.inline(chr(10).join(paragraph))}</h{level}>')
+                return i + 1
+            if _interrupts_paragraph(line):
+                break
+            paragraph.append(line.lstrip())
+            i += 1
+        out.append(f'<p>{self.inline(chr(10).join(paragraph))}</p>')
+        return i
+
+
+def render(markdown, context=None):
+    if not markdown:
+        return ''
+    # NUL is replaced as the spec says, it also marks the renderer's placeholders
+    lines = markdown.replace('\x00', '\ufffd').replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    return '\n'.join(_BlockParser(context).parse(lines)) + '\n'
@@ -1,30 +1,89 @@
+import hashlib
+import json
 import logging
-from typing import Callable
+import sys
+import threading
 
-from telegram import ParseMode, TelegramError
+from telegram import ParseMode
 from telegram.ext import CallbackContext, Dispatcher
 
-from bot.const import DEFAULT_TRUNCATION_LIMIT
+from bot.cache import LRUCache
+from bot.catalog import repo_catalogs
+from bot.executor import KeyedExecutor
+from bot.const import MARKDOWN_CACHE_SIZE, MARKDOWN_CACHE_TTL, MARKDOWN_RENDERER
 from bot.githubapi import github_api
 from bot.githubupdates import GithubAuthUpdate, GithubUpdate
+from bot.installations import installation_registry
+from bot.journal import webhook_journal
+from bot.markdown import get_renderer
 from bot.menu import edit_menu_by_id
-from bot.repo import Repo
+from bot.render import render_pool
+from bot.repo import FLAGS
+from bot.repoindex import repo_index
+from bot.sender import MessageScheduler
 from bot.utils import link, encode_data_link
-from bot.truncator import github_cleaner, truncate
+from bot.truncator import parse_fragment
 
 TRUNCATED_MESSAGE = '\n<b>[Truncated message, open on GitHub to read more]</b>'
 REPLY_MESSAGE = '\n\n<i>Reply to this message to post a comment on GitHub (use ! to suppress).</i>'
+# Parsed once here instead of for every notification
+TRUNCATED_MESSAGE_TOKENS = parse_fragment(TRUNCATED_MESSAGE)
+REPLY_MESSAGE_TOKENS = parse_fragment(REPLY_MESSAGE)
+# Deferred deliveries of a repository taken from the journal at once
+RETRY_BATCH = 100
+
+markdown_renderer = get_renderer(MARKDOWN_RENDERER)
+
+# Cleaned html tokens keyed on (sha256 of the markdown, repository context)
+markdown_cache = LRUCache(MARKDOWN_CACHE_SIZE, ttl=MARKDOWN_CACHE_TTL,
+                          sizeof=lambda tokens: sum(sys.getsizeof(token) + len(str(token.get('data', '')))
+                                                    for token in tokens))
 
 
 def render_github_markdown(markdown, context: str):
-    html = github_api.markdown(markdown, context)
-    return github_cleaner.clean(html).strip('\n')
+    # Returns the cleaned tokens rather than html, so that they don't have to be parsed again when truncating.
+    # The tokens are shared through the cache and must not be modified.
+    key = (hashlib.sha256((markdown or '').encode('utf-8')).digest(), context)
+    tokens = markdown_cache.get(key)
+    if tokens is None:
+        html = markdown_renderer.render(markdown, context)
+        tokens = render_pool.clean_tokens(html)
+        markdown_cache.set(key, tokens)
+    return tokens
+
+
+class _JournaledDelivery:
+    # Marks a delivery done in the webhook journal once it was handled and all the messages it sent went out,
+    # so that deliveries whose messages were still queued when the bot stopped are replayed as well
+    def __init__(self, journal_id):
+        self.journal_id = journal_id
+        # The handler itself counts as one until it is finished
+        self.pending = 1
+        self._lock = threading.Lock()
+
+    def add(self):
+        with self._lock:
+            self.pending += 1
+
+    def finish(self):
+        with self._lock:
+            self.pending -= 1
+            finished = not self.pending
+        if finished:
+            webhook_journal.done(self.journal_id)
 
 
 class GithubHandler:
-    def __init__(self, dispatcher: Dispatcher):
+    def __init__(self, dispatcher: Dispatcher, message_scheduler: MessageScheduler, executor: KeyedExecutor):
         self.dispatcher = dispatcher
+        self.message_scheduler = message_scheduler
+        self.executor = executor
         self.logger = logging.getLogger(self.__class__.__qualname__)
+        # The _JournaledDelivery being handled by the current thread, for _send
+        self._current = threading.local()
+        # Repository id -> journal id of its oldest delivery that didn't fit in the executor, see handle_update
+        self._deferred = {}
+        self._deferred_lock = threading.Lock()
 
     def handle_auth_update(self, update: GithubAuthUpdate, context: CallbackContext):
         user_id = update.state[0]
@@ -35,13 +94,65 @@ class GithubHandler:
         access_token = github_api.get_oauth_access_token(update.code, update.raw_state)
 
         context.user_data['access_token'] = access_token
+        # Not a telegram update, so the dispatcher won't tell the persistence about the change
+        if self.dispatcher.persistence:
+            self.dispatcher.persistence.update_user_data(user_id, context.user_data)
 
         from bot.settings import login_menu
         context.menu_stack = ['settings', 'login']
         edit_menu_by_id(user_id, message_id, context, login_menu)
 
     def handle_update(self, update: GithubUpdate, context: CallbackContext):
-        return getattr(self, update.event, self.unknown)(update, context)
+        # Runs outside the dispatcher thread so that a slow repository doesn't hold up everything else,
+        # but still in order for every single repository
+        repository = update.payload.get('repository') or {}
+        repo_id = repository.get('id')
+        with self._deferred_lock:
+            if repo_id in self._deferred:
+                # Has to wait for the deliveries before it, retry_deferred takes it from the journal after them
+                return
+            if self.executor.submit(repo_id, self._handle_update, update, context):
+                return
+            if update.journal_id is None:
+                self.logger.warning('Queue for repository %s is full, dropping delivery %s',
+                                    repository.get('full_name'), update.guid)
+                return
+            # The repository has too much queued already, rather than blocking the dispatcher the delivery
+            # (and every later one of the repository) is left in the webhook journal for retry_deferred
+            self.logger.warning('Queue for repository %s is full, deferring delivery %s',
+                                repository.get('full_name'), update.guid)
+            self._deferred[repo_id] = update.journal_id
+
+    def retry_deferred(self):
+        # Hands deferred deliveries from the webhook journal to the executor, oldest first for every repository,
+        # for as long as there is room. Has to be called periodically
+        with self._deferred_lock:
+            for repo_id, since in list(self._deferred.items()):
+                deliveries = webhook_journal.unfinished(repo_id, since, limit=RETRY_BATCH)
+                for journal_id, guid, event, body in deliveries:
+                    update = GithubUpdate(json.loads(body), guid, event, journal_id=journal_id)
+                    context = CallbackContext.from_update(update, self.dispatcher)
+                    if not self.executor.submit(repo_id, self._handle_update, update, context):
+                        self._deferred[repo_id] = journal_id
+                        break
+                else:
+                    if len(deliveries) < RETRY_BATCH:
+                        del self._deferred[repo_id]
+                    else:
+                        self._deferred[repo_id] = deliveries[-1][0] + 1
+
+    def _handle_update(self, update: GithubUpdate, context: CallbackContext):
+        delivery = _JournaledDelivery(update.journal_id) if update.journal_id is not None else None
+        self._current.delivery = delivery
+        try:
+            getattr(self, update.event, self.unknown)(update, context)
+        except Exception as e:
+            self.dispatcher.dispatch_error(update, e)
+        finally:
+            self._current.delivery = None
+            # Also when it failed, since replaying it would most likely just fail again
+            if delivery is not None:
+                delivery.finish()
 
     def unknown(self, update, _):
         self.logger.warning('Unknown event type %s. Data: %s', update.event, update.payload)
@@ -49,30 +160,27 @@ class GithubHandler:
     def ping(self, update, _):
         self.logger.info('PING: %s', update.payload)
 
-    def _iter_repos(self, repository):
-        repo_id = repository['id']
-        for chat_id, chat_data in self.dispatcher.chat_data.items():
-            if 'repos' in chat_data:
-                for repo in chat_data['repos'].values():
-                    if repo.id == repo_id:
-                        yield chat_id, chat_data, repo
-
-    def _send(self, repo, text, check_repo: Callable[[Repo], bool], suffix=REPLY_MESSAGE):
-        truncated_text = {}
-
-        for chat_id, chat_data, repo in self._iter_repos(repo):
-            if check_repo(repo):
-                truncation_limit = chat_data.get('truncation_limit', DEFAULT_TRUNCATION_LIMIT)
-                try:
-                    message_text = truncated_text[truncation_limit]
-                except KeyError:
-                    message_text = truncate(text, TRUNCATED_MESSAGE, suffix, max_length=truncation_limit)
-
-                try:
-                    self.dispatcher.bot.send_message(chat_id=chat_id, text=message_text,
-                                                     parse_mode=ParseMode.HTML, disable_web_page_preview=True)
-                except TelegramError:
-                    logging.error('error while sending github update', exc_info=1)
+    def _send(self, repo, text, settings: int, suffix=REPLY_MESSAGE_TOKENS, body=None):
+        # Sends to every chat that has any of the settings (a mask of bot.repo.FLAGS) turned on for repo
+        targets = repo_index.targets(repo['id'], settings)
+        if not targets:
+            return
+
+        tokens = parse_fragment(text)
+        if body:
+            tokens.extend(body)
+
+        # Only truncate once for every distinct limit, not once per chat
+        truncated_text = render_pool.truncate_many(tokens, TRUNCATED_MESSAGE_TOKENS, suffix,
+                                                   {limit for _, limit in targets})
+
+        delivery = getattr(self._current, 'delivery', None)
+        for chat_id, truncation_limit in targets:
+            if delivery is not None:
+                delivery.add()
+            self.message_scheduler.send_message(chat_id, truncated_text[truncation_limit],
+                                                callback=delivery.finish if delivery is not None else None,
+                                                parse_mode=ParseMode.HTML, disable_web_page_preview=True)
 
     def issues(self, update, _):
         # Issue opened, edited, closed, reopened, assigned, unassigned, labeled,
@@ -83,14 +191,14 @@ class GithubHandler:
             author = issue['user']
             repo = update.payload['repository']
 
-            text = render_github_markdown(issue['body'], repo['full_name'])
+            body = render_github_markdown(issue['body'], repo['full_name'])
 
             issue_link = link(issue['html_url'], f'{repo["full_name"]}#{issue["number"]} {issue["title"]}')
             author_link = link(author['html_url'], '@' + author['login'])
             data_link = encode_data_link(('issue', repo['full_name'], issue['number'], author['login']))
-            text = f'{data_link}🐛 New issue {issue_link}\nby {author_link}\n\n{text}'
+            text = f'{data_link}🐛 New issue {issue_link}\nby {author_link}\n\n'
 
-            self._send(repo, text, lambda r: r.issues)
+            self._send(repo, text, FLAGS['issues'], body=body)
 
     def issue_comment(self, update, context):
         # Any time a comment on an issue or pull request is created, edited, or deleted.
@@ -102,15 +210,15 @@ class GithubHandler:
             repo = update.payload['repository']
             is_pull_request = 'pull_request' in issue
 
-            text = render_github_markdown(comment['body'], repo['full_name'])
+            body = render_github_markdown(comment['body'], repo['full_name'])
 
             issue_link = link(issue['html_url'], f'{repo["full_name"]}#{issue["number"]} {issue["title"]}')
             author_link = link(author['html_url'], '@' + author['login'])
             data_link = encode_data_link(('pull request' if is_pull_request else 'issue',
                                           repo['full_name'], issue['number'], author['login']))
-            text = f'{data_link}💬 New comment on {issue_link}\nby {author_link}\n\n{text}'
+            text = f'{data_link}💬 New comment on {issue_link}\nby {author_link}\n\n'
 
-            self._send(repo, text, lambda r: r.pull_comments if is_pull_request else r.issue_comments)
+            self._send(repo, text, FLAGS['pull_comments' if is_pull_request else 'issue_comments'], body=body)
 
     def pull_request(self, update, context):
         # Pull request opened, closed, reopened, edited, assigned, unassigned, review requested,
@@ -121,15 +229,15 @@ class GithubHandler:
             author = pull_request['user']
             repo = update.payload['repository']
 
-            text = render_github_markdown(pull_request['body'], repo['full_name'])
+            body = render_github_markdown(pull_request['body'], repo['full_name'])
 
             pull_request_link = link(pull_request['html_url'],
                                      f'{repo["full_name"]}#{pull_request["number"]} {pull_request["title"]}')
             author_link = link(author['html_url'], '@' + author['login'])
             data_link = encode_data_link(('pull request', repo['full_name'], pull_request['number'], author['login']))
-            text = f'{data_link}🔌 New pull request {pull_request_link}\nby {author_link}\n\n{text}'
+            text = f'{data_link}🔌 New pull request {pull_request_link}\nby {author_link}\n\n'
 
-            self._send(repo, text, lambda r: r.pulls)
+            self._send(repo, text, FLAGS['pulls'], body=body)
 
     def pull_request_review(self, update, context):
         # Pull request review submitted, edited, or dismissed.
@@ -143,7 +251,7 @@ class GithubHandler:
             if not review['body']:
                 return
 
-            text = render_github_markdown(review['body'], repo['full_name'])
+            body = render_github_markdown(review['body'], repo['full_name'])
 
             review_link = link(review['html_url'],
                                f'{repo["full_name"]}#{pull_request["number"]} {pull_request["title"]}')
@@ -161,8 +269,8 @@ class GithubHandler:
                     state = 'Changes requested'
                     emoji = '‼️'
 
-                text = f'{data_link}{emoji} New pull request review {review_link}\n{state} by {author_link}\n\n{text}'
-                self._send(repo, text, lambda r: r.pull_reviews)
+                text = f'{data_link}{emoji} New pull request review {review_link}\n{state} by {author_link}\n\n'
+                self._send(repo, text, FLAGS['pull_reviews'], body=body)
 
     def pull_request_review_comment(self, update, context):
         # Pull request diff comment created, edited, or deleted.
@@ -174,7 +282,7 @@ class GithubHandler:
 
             diff_hunk = f'<pre>{comment["path"]}\n{comment["diff_hunk"]}</pre>'
 
-            text = render_github_markdown(comment['body'], repo['full_name'])
+            body = render_github_markdown(comment['body'], repo['full_name'])
 
             issue_link = link(comment['html_url'],
                               f'{repo["full_name"]}#{pull_request["number"]} {pull_request["title"]}')
@@ -184,9 +292,9 @@ class GithubHandler:
                                           pull_request['number'],
                                           comment['in_reply_to_id'] if 'in_reply_to_id' in comment else comment['id'],
                                           author['login'],))
-            text = f'{data_link}💬 New pull request review comment {issue_link}\nby {author_link}\n{diff_hunk}\n\n{text}'
+            text = f'{data_link}💬 New pull request review comment {issue_link}\nby {author_link}\n{diff_hunk}\n\n'
 
-            self._send(repo, text, lambda r: r.pull_review_comments)
+            self._send(repo, text, FLAGS['pull_review_comments'], body=body)
 
     def push(self, update, context):
         # Triggered on a push to a repository branch.
@@ -204,8 +312,11 @@ class GithubHandler:
             for commit in commits:
                 text += f'<a href="{commit["url"]}">{commit["id"][:7]}</a>: {commit["message"]} by {commit["author"]["name"]}\n'
 
-            self._send(repo, text, lambda r: (r.push_main or r.push) if branch == repo["default_branch"] else r.push,
-                       suffix='')
+            if branch == repo['default_branch']:
+                settings = FLAGS['push_main'] | FLAGS['push']
+            else:
+                settings = FLAGS['push']
+            self._send(repo, text, settings, suffix=None)
 
     def gollum(self, update, context):
         # Wiki page is created or updated.
@@ -221,7 +332,7 @@ class GithubHandler:
             compare_url = f'{page["html_url"]}/_compare/{page["sha"]}'
             text += f'<a href="{page["html_url"]}">{page["title"]}</a> (<a href="{compare_url}">compare</a>)\n'
 
-        self._send(repo, text, lambda r: r.wiki_pages, suffix='')
+        self._send(repo, text, FLAGS['wiki_pages'], suffix=None)
 
     def commit_comment(self, update, context):
         if update.payload['action'] == 'created':
@@ -243,20 +354,32 @@ class GithubHandler:
 
             text += f'\n\n{comment["body"]}'
 
-            self._send(repo, text, lambda r: r.commit_comments, suffix='')
-
-    # def integration_installation_repositories(self, update, context):
-    #     new_repos = [{'id': repo['id'], 'full_name': repo['full_name']} for repo in
-    #                  update.payload['repositories_added']]
-    #     # TODO: Implement repositories_removed
-    #
-    #     self.logger.debug('New installation repos: %s', new_repos)
-    #
-    #     context.github_data.setdefault('repos', []).extend(new_repos)
-    #
-    # def integration_installation(self, update, context):
-    #     new_repos = [{'id': repo['id'], 'full_name': repo['full_name']} for repo in update.payload['repositories']]
-    #
-    #     self.logger.debug('New installation. Repos: %s', new_repos)
-    #
-    #     context.github_data.setdefault('repos', []).extend(new_repos)
+            self._send(repo, text, FLAGS['commit_comments'], suffix=None)
+
+    def installation(self, update, _):
+        installation = update.payload['installation']
+        action = update.payload['action']
+
+        if action == 'deleted':
+            installation_registry.remove_installation(installation['id'])
+        elif 'repositories' in update.payload:
+            # Sent with everything the installation has access to when created
+            installation_registry.set_installation(installation, update.payload['repositories'])
+        else:
+            return
+
+        self.logger.debug('Installation %s %s', installation['id'], action)
+        repo_catalogs.clear()
+
+    def installation_repositories(self, update, _):
+        installation = update.payload['installation']
+
+        installation_registry.remove_repositories(installation['id'], update.payload['repositories_removed'])
+        if not installation_registry.add_repositories(installation['id'], update.payload['repositories_added']):
+            self.logger.debug('Repositories added to unknown installation %s', installation['id'])
+
+        repo_catalogs.clear()
+
+    # What these were called before github apps were out of beta
+    integration_installation = installation
+    integration_installation_repositories = installation_repositories
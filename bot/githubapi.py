@@ -1,41 +1,108 @@
+import hashlib
 import secrets
+import threading
 import time
-from urllib.parse import urlencode, parse_qs
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import urlencode, urlparse, parse_qs
 
 import jwt
 import requests
 from cachecontrol import CacheControl
 from requests.auth import AuthBase
 
+from bot.cache import LRUCache
 from bot.const import (GITHUB_PRIVATE_KEY_PATH, GITHUB_APP_ID, HMAC_SECRET, GITHUB_OAUTH_CLIENT_ID,
-                       GITHUB_OAUTH_CLIENT_SECRET, GITHUB_OAUTH_REDIRECT_URI)
+                       GITHUB_OAUTH_CLIENT_SECRET, GITHUB_OAUTH_REDIRECT_URI, GITHUB_PAGINATION_WORKERS,
+                       GITHUB_USER_CACHE_SIZE, GITHUB_USER_CACHE_TTL, GITHUB_HTTP_CACHE_SIZE,
+                       GITHUB_HTTP_CACHE_FILE, GITHUB_RATE_LIMIT_RESERVE, GITHUB_RATE_LIMIT_RETRIES,
+                       GITHUB_INTERACTIVE_MAX_WAIT, GITHUB_BACKGROUND_MAX_WAIT)
+from bot.httpcache import ResponseCache, ScopedCacheController
+from bot.ratelimit import INTERACTIVE, BACKGROUND, RateLimiter
 from bot.utils import secure_encode_64
 
 GITHUB_API_ACCEPT = {'Accept': 'application/vnd.github.machine-man-preview+json'}
 
 
+# Tokens are renewed this many seconds before they expire, so that they don't expire mid request
+TOKEN_EXPIRY_MARGIN = 60
+
+
 class JWTAuth(AuthBase):
     def __init__(self, app_id):
         self.iss = app_id
         with open(GITHUB_PRIVATE_KEY_PATH, 'rb') as f:
             self.private_key = f.read()
 
-    def __call__(self, r):
-        payload = {
-            'iat': int(time.time()),
-            'exp': int(time.time()) + 5 * 60,
-            'iss': self.iss
-        }
-        encoded = jwt.encode(payload, self.private_key, algorithm='RS256')
+        # Signing with RS256 is slow, so a token is reused until it is about to expire
+        self._token = None
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def token(self):
+        with self._lock:
+            now = int(time.time())
+            if self._token is None or now >= self._expires - TOKEN_EXPIRY_MARGIN:
+                payload = {
+                    'iat': now,
+                    'exp': now + 5 * 60,
+                    'iss': self.iss
+                }
+                encoded = jwt.encode(payload, self.private_key, algorithm='RS256')
+                # Older versions of PyJWT return bytes
+                self._token = encoded.decode('ascii') if isinstance(encoded, bytes) else encoded
+                self._expires = payload['exp']
+            return self._token
 
-        r.headers['Authorization'] = f'Bearer {encoded.decode("ascii")}'
+    def __call__(self, r):
+        r.headers['Authorization'] = f'Bearer {self.token()}'
 
         return r
 
 
+class InstallationTokens:
+    # Installation access tokens, shared by GithubAPI and AsyncGithubAPI. They are valid for an hour,
+    # so they are kept until shortly before that. Minting one is up to the caller, under lock(installation_id)
+    # (or a lock of its own per installation) so that concurrent callers don't each mint one.
+    def __init__(self):
+        # installation_id -> (token, unix time it expires)
+        self._tokens = {}
+        # installation_id -> lock held while minting its token, so that a slow call only holds up that installation
+        self._locks = {}
+        # Guards both of the above
+        self._lock = threading.Lock()
+
+    def get(self, installation_id):
+        # The token, or None if there is none that is still valid for long enough
+        with self._lock:
+            token, expires = self._tokens.get(installation_id, (None, 0))
+        return token if token is not None and time.time() < expires - TOKEN_EXPIRY_MARGIN else None
+
+    def lock(self, installation_id):
+        with self._lock:
+            lock = self._locks.get(installation_id)
+            if lock is None:
+                lock = self._locks[installation_id] = threading.Lock()
+            return lock
+
+    def store(self, installation_id, data):
+        # Takes the response of minting a token, returns the token
+        expires = datetime.strptime(data['expires_at'], '%Y-%m-%dT%H:%M:%SZ')
+        with self._lock:
+            self._tokens[installation_id] = (data['token'], expires.replace(tzinfo=timezone.utc).timestamp())
+        return data['token']
+
+
+class RateLimitExceeded(requests.RequestException):
+    # Raised instead of waiting any longer than the max_wait a call was given
+    pass
+
+
 class GithubAPI:
     def __init__(self):
-        self.s = CacheControl(requests.session())
+        self.response_cache = ResponseCache(GITHUB_HTTP_CACHE_SIZE, GITHUB_HTTP_CACHE_FILE or None)
+        self.s = CacheControl(requests.session(), cache=self.response_cache, controller_class=ScopedCacheController)
 
         self.app_id = GITHUB_APP_ID
         self.jwt_auth = JWTAuth(GITHUB_APP_ID)
@@ -44,7 +111,20 @@ class GithubAPI:
         self.oauth_client_secret = GITHUB_OAUTH_CLIENT_SECRET
         self.oauth_redirect_uri = GITHUB_OAUTH_REDIRECT_URI
 
-    def post(self, url, *args, api=True, jwt_bearer=False, oauth_server_auth=None, access_token=None, **kwargs):
+        self.pagination_pool = ThreadPoolExecutor(GITHUB_PAGINATION_WORKERS, thread_name_prefix='github_pagination')
+
+        self.installation_tokens = InstallationTokens()
+
+        self.rate_limiter = RateLimiter(GITHUB_RATE_LIMIT_RESERVE,
+                                        max_wait=(GITHUB_INTERACTIVE_MAX_WAIT, GITHUB_BACKGROUND_MAX_WAIT))
+
+        # Hash of access token -> (time fetched or revalidated, etag, user), counted in entries rather than bytes.
+        # Entries outlive the ttl so that they can be revalidated with their etag, which is free rate limit wise.
+        self.users = LRUCache(GITHUB_USER_CACHE_SIZE, sizeof=lambda _: 1)
+        self.users_ttl = GITHUB_USER_CACHE_TTL
+
+    def post(self, url, *args, api=True, jwt_bearer=False, oauth_server_auth=None, access_token=None,
+             installation_id=None, priority=INTERACTIVE, max_wait=None, **kwargs):
         headers = kwargs.pop('headers', {})
         auth = kwargs.pop('auth', None)
         data = kwargs.pop('data', None)
@@ -53,15 +133,19 @@ class GithubAPI:
             headers.update(GITHUB_API_ACCEPT)
         if jwt_bearer:
             auth = self.jwt_auth
+        if installation_id is not None:
+            access_token = self.get_installation_access_token(installation_id)
         if access_token:
             headers.update({'Authorization': f'token {access_token}'})
         if oauth_server_auth and (data or json):
             (data or json)['client_id'] = GITHUB_OAUTH_CLIENT_ID
             (data or json)['client_secret'] = GITHUB_OAUTH_CLIENT_SECRET
 
-        return self.s.post(url, *args, data=data, json=json, headers=headers, auth=auth, **kwargs)
+        return self._request(self.s.post, self._rate_limit_key(jwt_bearer, access_token, oauth_server_auth),
+                             priority, max_wait, url, *args, data=data, json=json, headers=headers, auth=auth, **kwargs)
 
-    def get(self, url, *args, api=True, jwt_bearer=False, oauth_server_auth=None, access_token=None, **kwargs):
+    def get(self, url, *args, api=True, jwt_bearer=False, oauth_server_auth=None, access_token=None,
+            installation_id=None, priority=INTERACTIVE, max_wait=None, **kwargs):
         headers = kwargs.pop('headers', {})
         auth = kwargs.pop('auth', None)
         data = kwargs.pop('data', None)
@@ -70,23 +154,105 @@ class GithubAPI:
             headers.update(GITHUB_API_ACCEPT)
         if jwt_bearer:
             auth = self.jwt_auth
+        if installation_id is not None:
+            access_token = self.get_installation_access_token(installation_id)
         if access_token:
             headers.update({'Authorization': f'token {access_token}'})
         if oauth_server_auth and (data or json):
             (data or json)['client_id'] = GITHUB_OAUTH_CLIENT_ID
             (data or json)['client_secret'] = GITHUB_OAUTH_CLIENT_SECRET
 
-        return self.s.get(url, *args, data=data, json=json, headers=headers, auth=auth, **kwargs)
+        return self._request(self.s.get, self._rate_limit_key(jwt_bearer, access_token, oauth_server_auth),
+                             priority, max_wait, url, *args, data=data, json=json, headers=headers, auth=auth, **kwargs)
 
-    def get_paginated(self, key, url, *args, **kwargs):
+    @staticmethod
+    def _rate_limit_key(jwt_bearer, access_token, oauth_server_auth):
+        # Github counts the rate limit per set of credentials
+        if jwt_bearer:
+            return 'app'
+        if access_token:
+            # Installation and user tokens alike
+            return 'token ' + hashlib.sha256(access_token.encode('utf-8')).hexdigest()[:16]
+        if oauth_server_auth:
+            return 'oauth_app'
+        return 'anonymous'
+
+    def _request(self, send, key, priority, max_wait, *args, **kwargs):
+        # Waits for the rate limit, and retries calls that hit it anyway (e.g. secondary rate limits)
+        for attempt in range(GITHUB_RATE_LIMIT_RETRIES + 1):
+            if not self.rate_limiter.acquire(key, priority, max_wait):
+                raise RateLimitExceeded(f'Rate limited on {key}')
+            r = send(*args, **kwargs)
+            # Responses from the cache have the headers of back when they were cached
+            if getattr(r, 'from_cache', False):
+                break
+            if not self.rate_limiter.update(key, r.status_code, r.headers, r.content):
+                break
+        return r
+
+    def get_installation_access_token(self, installation_id):
+        token = self.installation_tokens.get(installation_id)
+        if token is not None:
+            return token
+
+        with self.installation_tokens.lock(installation_id):
+            # Another thread may have minted it while this one waited
+            token = self.installation_tokens.get(installation_id)
+            if token is not None:
+                return token
+
+            r = self.post(f'https://api.github.com/app/installations/{installation_id}/access_tokens',
+                          jwt_bearer=True)
+
+            r.raise_for_status()
+
+            return self.installation_tokens.store(installation_id, r.json())
+
+    def _get_page(self, url, *args, **kwargs):
         r = self.get(url, *args, **kwargs)
         r.raise_for_status()
-        data = r.json()[key]
-        while 'link' in r.links.keys():
-            r = self.get(url, headers=r.request.headers)
-            r.raise_for_status()
-            data.extend(r.json()[key])
-        return data
+        return r
+
+    def iter_paginated(self, key, url, *args, per_page=100, **kwargs):
+        # Yields the items of every page, so that callers can stop early without fetching every page.
+        # When github says how many pages there are, the rest of them are fetched concurrently
+        kwargs['params'] = dict(kwargs.get('params') or {}, per_page=per_page)
+        kwargs.setdefault('priority', BACKGROUND)
+        r = self._get_page(url, *args, **kwargs)
+        yield from r.json()[key]
+        # The links already have all the params
+        del kwargs['params']
+
+        if 'next' not in r.links:
+            return
+
+        if 'last' not in r.links:
+            while 'next' in r.links:
+                r = self._get_page(r.links['next']['url'], *args, **kwargs)
+                yield from r.json()[key]
+            return
+
+        last = urlparse(r.links['last']['url'])
+        query = parse_qs(last.query)
+        page_urls = [last._replace(query=urlencode(dict(query, page=page), doseq=True)).geturl()
+                     for page in range(2, int(query['page'][0]) + 1)]
+
+        futures = deque()
+        try:
+            for page_url in page_urls:
+                futures.append(self.pagination_pool.submit(self._get_page, page_url, *args, **kwargs))
+                if len(futures) < GITHUB_PAGINATION_WORKERS:
+                    continue
+                yield from futures.popleft().result().json()[key]
+            while futures:
+                yield from futures.popleft().result().json()[key]
+        finally:
+            # If the caller stopped early
+            for future in futures:
+                future.cancel()
+
+    def get_paginated(self, key, url, *args, **kwargs):
+        return list(self.iter_paginated(key, url, *args, **kwargs))
 
     def oauth_authorize_url(self, *args):
         payload = {
@@ -116,11 +282,28 @@ class GithubAPI:
         return access_token
 
     def get_user(self, access_token):
-        r = self.get('https://api.github.com/user', access_token=access_token)
+        key = hashlib.sha256(access_token.encode('utf-8')).digest()
+        cached = self.users.get(key)
+        if cached is not None:
+            fetched, etag, user = cached
+            if time.monotonic() - fetched < self.users_ttl:
+                return user
+
+        headers = {'If-None-Match': cached[1]} if cached is not None and cached[1] else {}
+        r = self.get('https://api.github.com/user', access_token=access_token, headers=headers)
+
+        if r.status_code == 304:
+            self.users.set(key, (time.monotonic(), cached[1], cached[2]))
+            return cached[2]
 
         r.raise_for_status()
 
-        return r.json()
+        user = r.json()
+        self.users.set(key, (time.monotonic(), r.headers.get('ETag'), user))
+        return user
+
+    def forget_user(self, access_token):
+        self.users.delete(hashlib.sha256(access_token.encode('utf-8')).digest())
 
     def get_installations_for_user(self, access_token):
         data = self.get_paginated('installations',
@@ -128,11 +311,13 @@ class GithubAPI:
                                   access_token=access_token)
         return data
 
+    def iter_repositories_for_installation(self, installation_id, access_token):
+        return self.iter_paginated('repositories',
+                                   f'https://api.github.com/user/installations/{installation_id}/repositories',
+                                   access_token=access_token)
+
     def get_repositories_for_installation(self, installation_id, access_token):
-        data = self.get_paginated('repositories',
-                                  f'https://api.github.com/user/installations/{installation_id}/repositories',
-                                  access_token=access_token)
-        return data
+        return list(self.iter_repositories_for_installation(installation_id, access_token))
 
     def get_repository(self, repo_id, access_token):
         r = self.get(f'https://api.github.com/repositories/{repo_id}', access_token=access_token)
@@ -141,12 +326,12 @@ class GithubAPI:
 
         return r.json()
 
-    def markdown(self, markdown, context):
+    def markdown(self, markdown, context, max_wait=None):
         r = self.post(f'https://api.github.com/markdown', json={
             'text': markdown,
             'mode': 'gfm',
             'context': context
-        }, oauth_server_auth=True)
+        }, oauth_server_auth=True, priority=BACKGROUND, max_wait=max_wait)
 
         r.raise_for_status()
 
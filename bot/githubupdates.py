@@ -2,10 +2,12 @@ class GithubUpdate(object):
     effective_chat = None
     effective_user = None
 
-    def __init__(self, payload, guid, event):
+    def __init__(self, payload, guid, event, journal_id=None):
         self.payload = payload
         self.guid = guid
         self.event = event
+        # Id in the webhook journal, to mark the delivery as done once handled
+        self.journal_id = journal_id
 
 
 class GithubAuthUpdate(object):
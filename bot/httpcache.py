@@ -0,0 +1,167 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+from cachecontrol import CacheController
+from cachecontrol.cache import BaseCache
+
+from bot.cache import LRUCache
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    data BLOB NOT NULL,
+    expires REAL,
+    used REAL NOT NULL
+)
+'''
+
+
+class ResponseCache(BaseCache):
+    # Cache of serialized responses for CacheControl, limited to max_bytes and evicting the least recently used.
+    # With a filename they are also kept in sqlite (limited to max_bytes as well), so that they survive restarts.
+    def __init__(self, max_bytes, filename=None):
+        self.logger = logging.getLogger(self.__class__.__qualname__)
+
+        self.max_bytes = max_bytes
+        self.filename = filename
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+
+        # key -> (unix time it expires or None, data)
+        self._memory = LRUCache(max_bytes, sizeof=lambda item: len(item[1]))
+        # Set by ScopedCacheController for the duration of a lookup, see there
+        self.scope = threading.local()
+
+        self._conn = None
+        self._conn_lock = threading.Lock()
+        self._disk_bytes = 0
+        if filename:
+            self._conn = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            # Losing the last few responses in a crash only means fetching them again
+            self._conn.execute('PRAGMA synchronous=OFF')
+            self._conn.execute(_SCHEMA)
+            self._conn.execute('CREATE INDEX IF NOT EXISTS responses_used ON responses (used)')
+            self._disk_bytes = self._conn.execute('SELECT COALESCE(SUM(LENGTH(data)), 0) FROM responses').fetchone()[0]
+
+    def _key(self, key):
+        prefix = getattr(self.scope, 'prefix', None)
+        return f'{prefix} {key}' if prefix else key
+
+    def get(self, key):
+        key = self._key(key)
+        item = self._memory.get(key)
+        if item is None and self._conn is not None:
+            with self._conn_lock:
+                row = self._conn.execute('SELECT expires, data FROM responses WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    self._conn.execute('UPDATE responses SET used = ? WHERE key = ?', (time.time(), key))
+            if row is not None:
+                item = row
+                self._memory.set(key, item)
+
+        expires, data = item if item is not None else (None, None)
+        if data is not None and expires is not None and expires < time.time():
+            self._delete(key)
+            data = None
+
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    def set(self, key, value, expires=None):
+        # CacheControl passes expires as seconds from now, or as a datetime in newer versions
+        if isinstance(expires, datetime):
+            expires = expires.replace(tzinfo=expires.tzinfo or timezone.utc).timestamp()
+        elif expires is not None:
+            expires = time.time() + expires
+
+        key = self._key(key)
+        self._memory.set(key, (expires, value))
+        if self._conn is not None:
+            with self._conn_lock:
+                try:
+                    self._write(key, value, expires)
+                except sqlite3.Error:
+                    self.logger.warning('Error while storing response', exc_info=1)
+
+    def _write(self, key, value, expires):
+        self._conn.execute('BEGIN')
+        old = self._conn.execute('SELECT LENGTH(data) FROM responses WHERE key = ?', (key,)).fetchone()
+        self._conn.execute('INSERT OR REPLACE INTO responses (key, data, expires, used) VALUES (?, ?, ?, ?)',
+                           (key, value, expires, time.time()))
+        self._disk_bytes += len(value) - (old[0] if old else 0)
+
+        # Evict the least recently used responses, a bunch at a time
+        while self._disk_bytes > self.max_bytes:
+            rows = self._conn.execute('SELECT key, LENGTH(data) FROM responses ORDER BY used LIMIT 100').fetchall()
+            if not rows:
+                break
+            self._conn.executemany('DELETE FROM responses WHERE key = ?', ((row[0],) for row in rows))
+            self._disk_bytes -= sum(row[1] for row in rows)
+        self._conn.execute('COMMIT')
+
+    def delete(self, key):
+        self._delete(self._key(key))
+
+    def _delete(self, key):
+        self._memory.delete(key)
+        if self._conn is not None:
+            with self._conn_lock:
+                row = self._conn.execute('SELECT LENGTH(data) FROM responses WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    self._conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                    self._disk_bytes -= row[0]
+
+    def close(self):
+        if self._conn is not None:
+            with self._conn_lock:
+                self._conn.close()
+                self._conn = None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'revalidated': self.revalidated,
+            'memory': self._memory.stats(),
+            'disk_bytes': self._disk_bytes
+        }
+
+
+def _scoped(method):
+    def wrapper(self, request, *args, **kwargs):
+        authorization = request.headers.get('Authorization')
+        previous = getattr(self.cache.scope, 'prefix', None)
+        self.cache.scope.prefix = hashlib.sha256(authorization.encode('utf-8')).hexdigest() if authorization else None
+        try:
+            return method(self, request, *args, **kwargs)
+        finally:
+            self.cache.scope.prefix = previous
+
+    return wrapper
+
+
+class ScopedCacheController(CacheController):
+    # CacheControl keys responses on the url alone, so that users would overwrite each other's responses
+    # (and only Vary would keep them from being served someone else's). This keys them on the credentials
+    # of the request as well, by telling the ResponseCache about them for the duration of each call.
+    cached_request = _scoped(CacheController.cached_request)
+    conditional_headers = _scoped(CacheController.conditional_headers)
+    cache_response = _scoped(CacheController.cache_response)
+
+    @_scoped
+    def update_cached_response(self, request, response):
+        # Called for a 304, which github doesn't count against the rate limit
+        self.cache.revalidated += 1
+        return super().update_cached_response(request, response)
@@ -0,0 +1,95 @@
+import threading
+
+# Keys of a repository in installation webhooks that are kept
+_REPOSITORY_KEYS = ('id', 'name', 'full_name', 'private')
+
+
+# Which repositories every installation of the app has access to, kept current from the installation
+# and installation_repositories webhooks, so that they don't have to be listed through the api.
+# Lives in github_data, and is only complete for installations that were created (or changed) since it exists.
+class InstallationRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # installation_id -> {'account': {'id', 'login', 'avatar_url'}, 'repositories': {repo_id: repository}}
+        self._installations = {}
+        # repo_id -> installation_id
+        self._repo_installations = {}
+
+    def bind(self, installations):
+        # Takes the (persisted) dict to keep the registry in
+        with self._lock:
+            self._installations = installations
+            self._repo_installations = {repo_id: installation_id
+                                        for installation_id, installation in installations.items()
+                                        for repo_id in installation['repositories']}
+
+    @staticmethod
+    def _repository(repo):
+        return {key: repo.get(key) for key in _REPOSITORY_KEYS}
+
+    def set_installation(self, installation, repositories):
+        account = installation['account']
+        with self._lock:
+            old = self._installations.get(installation['id'])
+            if old is not None:
+                for repo_id in old['repositories']:
+                    self._repo_installations.pop(repo_id, None)
+            self._installations[installation['id']] = {
+                'account': {'id': account['id'], 'login': account['login'], 'avatar_url': account['avatar_url']},
+                'repositories': {repo['id']: self._repository(repo) for repo in repositories}
+            }
+            for repo in repositories:
+                self._repo_installations[repo['id']] = installation['id']
+
+    def remove_installation(self, installation_id):
+        with self._lock:
+            installation = self._installations.pop(installation_id, None)
+            if installation is not None:
+                for repo_id in installation['repositories']:
+                    self._repo_installations.pop(repo_id, None)
+
+    def add_repositories(self, installation_id, repositories):
+        # Returns False if the installation isn't known, in which case nothing was added
+        with self._lock:
+            installation = self._installations.get(installation_id)
+            if installation is None:
+                return False
+            for repo in repositories:
+                installation['repositories'][repo['id']] = self._repository(repo)
+                self._repo_installations[repo['id']] = installation_id
+            return True
+
+    def remove_repositories(self, installation_id, repositories):
+        with self._lock:
+            installation = self._installations.get(installation_id)
+            if installation is None:
+                return
+            for repo in repositories:
+                installation['repositories'].pop(repo['id'], None)
+                if self._repo_installations.get(repo['id']) == installation_id:
+                    del self._repo_installations[repo['id']]
+
+    def account(self, installation_id):
+        with self._lock:
+            installation = self._installations.get(installation_id)
+            return installation['account'] if installation is not None else None
+
+    def repositories(self, installation_id):
+        # The repositories of an installation, or None if it isn't known
+        with self._lock:
+            installation = self._installations.get(installation_id)
+            return list(installation['repositories'].values()) if installation is not None else None
+
+    def installation_for(self, repo_id):
+        with self._lock:
+            return self._repo_installations.get(repo_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'installations': len(self._installations),
+                'repositories': len(self._repo_installations)
+            }
+
+
+installation_registry = InstallationRegistry()
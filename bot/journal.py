@@ -0,0 +1,184 @@
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+from bot.const import WEBHOOK_JOURNAL_FILE, WEBHOOK_JOURNAL_RETENTION
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS deliveries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    guid TEXT,
+    event TEXT NOT NULL,
+    body TEXT NOT NULL,
+    received REAL NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    repo_id INTEGER
+)
+'''
+
+
+class WebhookJournal:
+    # Write-ahead journal of github webhook deliveries, so that deliveries that were acknowledged to github
+    # but not yet handled when the bot stopped can be replayed on startup.
+    # All writes go through one thread, which commits everything that queued up while it was busy at once.
+    def __init__(self, filename, retention=24 * 60 * 60, max_batch=500):
+        self.logger = logging.getLogger(self.__class__.__qualname__)
+
+        self.filename = filename
+        self.retention = retention
+        self.max_batch = max_batch
+
+        self.commits = 0
+        self.appended = 0
+        self.completed = 0
+
+        self._queue = queue.Queue()
+        self._conn = None
+        self._reader = None
+        self._thread = None
+        self._last_prune = 0
+
+    def open(self):
+        # Delivery workers write to the same file from other processes, hence the generous timeout
+        self._conn = sqlite3.connect(self.filename, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        # Deliveries are acknowledged once committed, so commits have to survive power loss
+        self._conn.execute('PRAGMA synchronous=FULL')
+        self._conn.execute(_SCHEMA)
+        if 'repo_id' not in [row[1] for row in self._conn.execute('PRAGMA table_info(deliveries)')]:
+            # Journals from before delivery workers existed
+            self._conn.execute('ALTER TABLE deliveries ADD COLUMN repo_id INTEGER')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS deliveries_pending ON deliveries (done, id)')
+
+    def start(self):
+        if self._conn is None:
+            self.open()
+        self._thread = threading.Thread(target=self._writer, name='webhook_journal', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def append(self, guid, event, body, repo_id=None):
+        # Returns a Future that resolves to the id of the delivery once it is safely on disk
+        future = Future()
+        self._queue.put(('append', (guid, event, body, time.time(), repo_id), future))
+        return future
+
+    def done(self, delivery_id):
+        self._queue.put(('done', delivery_id, None))
+
+    def pending(self, without_repository=False):
+        # (id, guid, event, body) of every delivery that was not done, oldest first.
+        # Only meant to be called before start()
+        if self._conn is None:
+            self.open()
+        where = 'done = 0 AND repo_id IS NULL' if without_repository else 'done = 0'
+        return self._conn.execute(f'SELECT id, guid, event, body FROM deliveries WHERE {where} ORDER BY id').fetchall()
+
+    def _read(self, sql, parameters):
+        if self._reader is None:
+            # Separate from the connection of the writer thread, which may be in the middle of a transaction
+            self._reader = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+        return self._reader.execute(sql, parameters).fetchall()
+
+    def claim(self, partition, partitions, after, limit=100):
+        # (id, guid, event, body) of deliveries that were not done yet, oldest first, for delivery worker
+        # `partition` of `partitions`. Every repository belongs to one partition, so its deliveries stay in order.
+        # Pass the last id returned so far as after.
+        return self._read('SELECT id, guid, event, body FROM deliveries '
+                          'WHERE done = 0 AND repo_id IS NOT NULL AND repo_id % ? = ? AND id > ? '
+                          'ORDER BY id LIMIT ?', (partitions, partition, after, limit))
+
+    def unfinished(self, repo_id, since, limit=100):
+        # (id, guid, event, body) of the deliveries for a repository (None for those without one)
+        # from id since onwards that were not done yet, oldest first
+        return self._read('SELECT id, guid, event, body FROM deliveries WHERE done = 0 AND repo_id IS ? AND id >= ? '
+                          'ORDER BY id LIMIT ?', (repo_id, since, limit))
+
+    def recent_guids(self, since):
+        # (guid, time received) of deliveries received since the given unix time, oldest first.
+        # Also only meant to be called before start()
+        if self._conn is None:
+            self.open()
+        return self._conn.execute('SELECT guid, received FROM deliveries WHERE guid IS NOT NULL AND received >= ? '
+                                  'ORDER BY id', (since,)).fetchall()
+
+    def _writer(self):
+        while True:
+            op = self._queue.get()
+            if op is None:
+                return
+
+            batch = [op]
+            stop = False
+            while len(batch) < self.max_batch:
+                try:
+                    op = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if op is None:
+                    stop = True
+                    break
+                batch.append(op)
+
+            self._commit(batch)
+
+            if stop:
+                return
+
+    def _commit(self, batch):
+        ids = []
+        try:
+            self._conn.execute('BEGIN')
+            for kind, data, future in batch:
+                if kind == 'append':
+                    ids.append(self._conn.execute('INSERT INTO deliveries (guid, event, body, received, repo_id) '
+                                                  'VALUES (?, ?, ?, ?, ?)', data).lastrowid)
+                else:
+                    self._conn.execute('UPDATE deliveries SET done = 1 WHERE id = ?', (data,))
+                    ids.append(None)
+            if time.monotonic() - self._last_prune > 60:
+                self._conn.execute('DELETE FROM deliveries WHERE done = 1 AND received < ?',
+                                   (time.time() - self.retention,))
+                self._last_prune = time.monotonic()
+            self._conn.execute('COMMIT')
+        except sqlite3.Error as e:
+            self.logger.exception('Error while writing to webhook journal')
+            if self._conn.in_transaction:
+                self._conn.execute('ROLLBACK')
+            for _, _, future in batch:
+                if future is not None:
+                    future.set_exception(e)
+            return
+
+        self.commits += 1
+        for (kind, _, future), delivery_id in zip(batch, ids):
+            if kind == 'append':
+                self.appended += 1
+                future.set_result(delivery_id)
+            else:
+                self.completed += 1
+
+    def stats(self):
+        return {
+            'commits': self.commits,
+            'appended': self.appended,
+            'completed': self.completed,
+            'queued': self._queue.qsize()
+        }
+
+
+webhook_journal = WebhookJournal(WEBHOOK_JOURNAL_FILE, retention=WEBHOOK_JOURNAL_RETENTION)
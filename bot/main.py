@@ -5,14 +5,22 @@ from telegram import Update, ParseMode, InlineKeyboardMarkup, InlineKeyboardButt
 from telegram.ext import TypeHandler, CallbackContext, CommandHandler, MessageHandler, Filters
 
 from bot import settings
-from bot.const import TELEGRAM_BOT_TOKEN, DATABASE_FILE, DEBUG
+from bot.asyncgithubapi import async_github_api
+from bot.const import (TELEGRAM_BOT_TOKEN, DATABASE_FILE, DEBUG, SEND_WORKERS, SEND_GLOBAL_RATE,
+                       SEND_CHAT_RATE, GITHUB_WORKERS, GITHUB_QUEUE_SIZE, PERSISTENCE_BACKEND, PROCESS_MODE,
+                       DELIVERY_WORKERS, DELIVERY_POLL_INTERVAL, DELIVERY_SUBSCRIPTIONS_REFRESH)
+from bot.executor import KeyedExecutor
 from bot.github import GithubHandler
 from bot.githubapi import github_api
 from bot.githubupdates import GithubUpdate, GithubAuthUpdate
+from bot.journal import webhook_journal
 from bot.menu import reply_menu
-from bot.persistence import Persistence
+from bot.persistence import get_persistence
+from bot.render import render_pool
+from bot.sender import MessageScheduler
 from bot.utils import decode_first_data_entity, deep_link, reply_data_link_filter
 from bot.webhookupdater import WebhookUpdater
+from bot.worker import DeliveryWorkers
 
 if DEBUG:
     http.client.HTTPConnection.debuglevel = 5
@@ -128,29 +136,56 @@ def reply_handler(update: Update, context: CallbackContext):
         repo, number, author = data
         text = f'@{author} {msg.text_html}'
 
-        github_api.add_issue_comment(repo, number, text, access_token=access_token)
+        comment = async_github_api.add_issue_comment(repo, number, text, access_token=access_token)
     elif comment_type == 'pull request review comment':
         repo, number, comment_id, author = data
         text = f'@{author} {msg.text_html}'
 
-        github_api.add_review_comment(repo, number, comment_id, text, access_token=access_token)
+        comment = async_github_api.add_review_comment(repo, number, comment_id, text, access_token=access_token)
+    else:
+        return
+
+    # CallbackContext doesn't expose the dispatcher in this version of PTB
+    dispatcher = context._dispatcher
+
+    def done(future):
+        if not future.cancelled() and future.exception() is not None:
+            dispatcher.dispatch_error(update, future.exception())
+
+    # Posted from the webhook server's IOLoop, so that this thread doesn't wait on github
+    async_github_api.submit(comment).add_done_callback(done)
 
 
 if __name__ == '__main__':
     # Not strictly needed anymore since we no longer have custom persistent data
     # But since we likely will want it in the future, we keep our custom persistence
-    persistence = Persistence(DATABASE_FILE)
+    persistence = get_persistence(PERSISTENCE_BACKEND, DATABASE_FILE)
+    # The delivery workers read the subscriptions from the sqlite database
+    split = PROCESS_MODE == 'split'
+    if split and PERSISTENCE_BACKEND != 'sqlite':
+        raise ValueError('PROCESS_MODE split needs the sqlite persistence backend')
     # Init our very custom webhook handler
+    # The connection pool needs room for the message scheduler workers on top of what PTB itself uses
     updater = WebhookUpdater(TELEGRAM_BOT_TOKEN,
                              updater_kwargs={'use_context': True,
-                                             'persistence': persistence})
+                                             'persistence': persistence,
+                                             'request_kwargs': {'con_pool_size': 4 + 4 + SEND_WORKERS}},
+                             split=split)
     dp = updater.dispatcher
 
+    # Sends notifications in the background while respecting telegram's rate limits
+    message_scheduler = MessageScheduler(dp.bot, workers=SEND_WORKERS,
+                                         global_rate=SEND_GLOBAL_RATE, chat_rate=SEND_CHAT_RATE)
+
+    # Handles github updates concurrently across repositories, in order within each one
+    github_executor = KeyedExecutor(workers=GITHUB_WORKERS, max_queue=GITHUB_QUEUE_SIZE)
+
     # See persistence note above
     CallbackContext.github_data = property(lambda self: persistence.github_data)
 
-    # Save data every five (5) min
-    dp.job_queue.run_repeating(lambda *_: persistence.flush(), 5 * 60)
+    # Save data every five (5) min, or as often as the delivery workers look for changed subscriptions
+    dp.job_queue.run_repeating(lambda *_: persistence.flush_in_background(),
+                               DELIVERY_SUBSCRIPTIONS_REFRESH if split else 5 * 60)
 
     # Telegram updates
     dp.add_handler(CommandHandler('start', start_handler))
@@ -164,10 +199,27 @@ if __name__ == '__main__':
     dp.add_handler(MessageHandler(Filters.reply & reply_data_link_filter, reply_handler))
 
     # Non-telegram updates
-    github_handler = GithubHandler(dp)
+    github_handler = GithubHandler(dp, message_scheduler, github_executor)
     dp.add_handler(TypeHandler(GithubUpdate, github_handler.handle_update))
     dp.add_handler(TypeHandler(GithubAuthUpdate, github_handler.handle_auth_update))
+    # Deliveries for repositories with a full queue wait in the webhook journal
+    dp.job_queue.run_repeating(lambda *_: github_handler.retry_deferred(), DELIVERY_POLL_INTERVAL)
 
     dp.add_error_handler(error_handler)
 
+    # Handle the deliveries for repositories in processes of their own
+    delivery_workers = DeliveryWorkers(DELIVERY_WORKERS if split else 0)
+
+    render_pool.start()
+    message_scheduler.start()
+    github_executor.start()
+    delivery_workers.start()
+    # Replays the webhook journal and starts it
     updater.start()
+    delivery_workers.stop()
+    github_executor.stop()
+    message_scheduler.stop()
+    render_pool.stop()
+    github_api.response_cache.close()
+    # Last, so that updates still being handled above get marked as done
+    webhook_journal.stop()
@@ -0,0 +1,86 @@
+import logging
+
+from requests import RequestException
+
+from bot import gfm
+from bot.githubapi import github_api
+from bot.truncator import github_cleaner
+
+
+class MarkdownRenderer:
+    def render(self, markdown, context):
+        raise NotImplementedError
+
+
+class GithubAPIRenderer(MarkdownRenderer):
+    def __init__(self, max_wait=None):
+        # How long to wait for the rate limit before raising RateLimitExceeded, by default the api's own
+        self.max_wait = max_wait
+
+    def render(self, markdown, context):
+        return github_api.markdown(markdown, context, max_wait=self.max_wait)
+
+
+class LocalRenderer(MarkdownRenderer):
+    def render(self, markdown, context):
+        return gfm.render(markdown, context)
+
+
+class FallbackRenderer(MarkdownRenderer):
+    def __init__(self, primary, fallback):
+        self.primary = primary
+        self.fallback = fallback
+        self.fallbacks = 0
+        self.logger = logging.getLogger(self.__class__.__qualname__)
+
+    def render(self, markdown, context):
+        try:
+            return self.primary.render(markdown, context)
+        except RequestException as e:
+            # Errors end up here through raise_for_status, rate limiting as RateLimitExceeded
+            self.fallbacks += 1
+            self.logger.warning('Markdown rendering failed (%s), falling back to %s',
+                                e, self.fallback.__class__.__qualname__)
+            return self.fallback.render(markdown, context)
+
+
+class ShadowRenderer(MarkdownRenderer):
+    def __init__(self, primary, shadow):
+        self.primary = primary
+        self.shadow = shadow
+        self.matches = 0
+        self.mismatches = 0
+        self.logger = logging.getLogger(self.__class__.__qualname__)
+
+    def render(self, markdown, context):
+        html = self.primary.render(markdown, context)
+
+        try:
+            shadow_html = self.shadow.render(markdown, context)
+        except Exception:
+            self.logger.exception('Shadow markdown renderer failed')
+            return html
+
+        # Only differences that survive cleaning matter
+        expected, actual = github_cleaner.clean(html), github_cleaner.clean(shadow_html)
+        if expected == actual:
+            self.matches += 1
+        else:
+            self.mismatches += 1
+            self.logger.info('Shadow markdown mismatch (%d/%d). Markdown: %r Expected: %r Got: %r',
+                             self.mismatches, self.matches + self.mismatches, markdown, expected, actual)
+
+        return html
+
+
+def get_renderer(mode):
+    if mode == 'api':
+        return GithubAPIRenderer()
+    elif mode == 'local':
+        return LocalRenderer()
+    elif mode == 'fallback':
+        # No point in waiting for the rate limit when it can be rendered locally right away
+        return FallbackRenderer(GithubAPIRenderer(max_wait=0), LocalRenderer())
+    elif mode == 'shadow':
+        return ShadowRenderer(GithubAPIRenderer(), LocalRenderer())
+    raise ValueError(f'Unknown markdown renderer {mode!r}')
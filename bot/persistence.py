@@ -1,12 +1,108 @@
+import hashlib
+import logging
+import os
 import pickle
-from collections import defaultdict
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict
 
-from telegram.ext import PicklePersistence
+from telegram.ext import BasePersistence, PicklePersistence
 
+from bot.const import DEFAULT_TRUNCATION_LIMIT, PERSISTENCE_CACHE_SIZE
+from bot.installations import installation_registry
+from bot.repoindex import repo_index
 
-class Persistence(PicklePersistence):
+
+def _copy(value):
+    # Copies the containers, but not the objects in them.
+    # Enough to keep what is being pickled from changing size halfway through.
+    if isinstance(value, dict):
+        value = value.copy()
+        for key, item in value.items():
+            if isinstance(item, (dict, list, set)):
+                value[key] = _copy(item)
+    elif isinstance(value, list):
+        value = [_copy(item) if isinstance(item, (dict, list, set)) else item for item in value]
+    elif isinstance(value, set):
+        value = set(value)
+    return value
+
+
+def _snapshot(value):
+    while True:
+        try:
+            return _copy(value)
+        except RuntimeError:
+            # Changed size while being copied, just try again
+            pass
+
+
+class SnapshotFlushMixin:
+    # Flushing takes a snapshot of the data (which is quick) and writes that (which is slow),
+    # so that the writing can happen in the background without holding up anything else.
+    # Subclasses implement _take_snapshot and _write_snapshot, the latter returning the number of bytes written.
+    def _init_flush(self):
+        self.logger = logging.getLogger(self.__class__.__qualname__)
+        self.last_flush = {'snapshot': 0.0, 'duration': 0.0, 'bytes': 0}
+        # Held while a snapshot is being taken or written, so only one flush happens at a time
+        self._flush_lock = threading.Lock()
+
+    def _take_snapshot(self):
+        raise NotImplementedError
+
+    def _write_snapshot(self, snapshot):
+        raise NotImplementedError
+
+    def _write(self, snapshot, snapshot_duration):
+        start = time.perf_counter()
+        try:
+            written = self._write_snapshot(snapshot)
+        finally:
+            self._flush_lock.release()
+        self.last_flush = {'snapshot': snapshot_duration, 'duration': time.perf_counter() - start, 'bytes': written}
+        self.logger.debug('Flushed %(bytes)d bytes in %(duration).3f sec (snapshot took %(snapshot).3f sec)',
+                          self.last_flush)
+
+    def _snapshot_timed(self):
+        start = time.perf_counter()
+        snapshot = self._take_snapshot()
+        return snapshot, time.perf_counter() - start
+
+    def flush(self):
+        # Blocks until everything is written, for shutdown
+        self._flush_lock.acquire()
+        try:
+            snapshot, snapshot_duration = self._snapshot_timed()
+        except BaseException:
+            self._flush_lock.release()
+            raise
+        self._write(snapshot, snapshot_duration)
+
+    def flush_in_background(self):
+        if not self._flush_lock.acquire(blocking=False):
+            self.logger.warning('Previous flush is still running, skipping this one')
+            return
+        try:
+            snapshot, snapshot_duration = self._snapshot_timed()
+        except BaseException:
+            self._flush_lock.release()
+            raise
+        # Not a daemon, so that exiting waits for the write to finish
+        threading.Thread(target=self._write_in_background, args=(snapshot, snapshot_duration),
+                         name='persistence_flush').start()
+
+    def _write_in_background(self, snapshot, snapshot_duration):
+        try:
+            self._write(snapshot, snapshot_duration)
+        except Exception:
+            self.logger.exception('Error while flushing in the background')
+
+
+class Persistence(SnapshotFlushMixin, PicklePersistence):
     def __init__(self, filename):
         super().__init__(filename, store_user_data=True, store_chat_data=True, singe_file=True, on_flush=True)
+        self._init_flush()
 
         self.github_data = None
 
@@ -29,8 +125,408 @@ class Persistence(PicklePersistence):
         except Exception:
             raise TypeError("Something went wrong unpickling {}".format(filename))
 
+        repo_index.rebuild(self.chat_data)
+        installation_registry.bind(self.github_data.setdefault('installations', {}))
+
+    def _take_snapshot(self):
+        return _snapshot({'conversations': self.conversations, 'user_data': self.user_data,
+                          'chat_data': self.chat_data, 'github_data': self.github_data})
+
+    def _write_snapshot(self, snapshot):
+        # Written next to the database and renamed over it, so that a crash never leaves half a database behind
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, "wb") as f:
+            pickle.dump(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+            written = f.tell()
+        os.replace(tmp_filename, self.filename)
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.filename)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        return written
+
     def dump_singlefile(self):
-        with open(self.filename, "wb") as f:
-            all = {'conversations': self.conversations, 'user_data': self.user_data,
-                   'chat_data': self.chat_data, 'github_data': self.github_data}
-            pickle.dump(all, f)
+        self._write_snapshot(self._take_snapshot())
+
+    def flush(self):
+        if self.user_data or self.chat_data or self.conversations:
+            SnapshotFlushMixin.flush(self)
+
+    def flush_in_background(self):
+        if self.user_data or self.chat_data or self.conversations:
+            SnapshotFlushMixin.flush_in_background(self)
+
+
+class LazyRows(defaultdict):
+    # Stands in for the defaultdict(dict) of user or chat data (and is one, since the dispatcher insists on that),
+    # but only loads entries when they are first used, and forgets the least recently used ones again when they
+    # take up more than max_bytes. Entries that are pinned (because they have changes that aren't written yet)
+    # or were used in the last min_idle seconds are never forgotten, so that nobody ends up holding on to a
+    # forgotten dict. Iterating only covers the entries that are loaded. The rest is on disk as it is,
+    # which is all that the dispatcher and flushing need.
+    def __init__(self, load, max_bytes, min_idle=60, on_evict=None):
+        super().__init__(dict)
+        self._load = load
+        self.max_bytes = max_bytes
+        self.min_idle = min_idle
+        self._on_evict = on_evict
+
+        self.size = 0
+        self.loads = 0
+        self.evictions = 0
+
+        # key -> [size, last used] of the loaded entries, least recently used first
+        self._meta = OrderedDict()
+        self._pinned = set()
+        self._lock = threading.RLock()
+
+    def _add(self, key, data, size):
+        dict.__setitem__(self, key, data)
+        self._meta[key] = [size, time.monotonic()]
+        self.size += size
+        self._evict()
+
+    def __missing__(self, key):
+        with self._lock:
+            loaded = self._load(key)
+            self.loads += 1
+            data, size = loaded if loaded is not None else ({}, 0)
+            self._add(key, data, size)
+            return data
+
+    def __getitem__(self, key):
+        with self._lock:
+            # Calls __missing__ when it isn't loaded
+            data = dict.__getitem__(self, key)
+            meta = self._meta.get(key)
+            if meta is not None:
+                meta[1] = time.monotonic()
+                self._meta.move_to_end(key)
+            return data
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __setitem__(self, key, data):
+        with self._lock:
+            dict.__setitem__(self, key, data)
+            meta = self._meta.get(key)
+            if meta is None:
+                self._meta[key] = [0, time.monotonic()]
+            else:
+                meta[1] = time.monotonic()
+                self._meta.move_to_end(key)
+
+    def __delitem__(self, key):
+        with self._lock:
+            dict.__delitem__(self, key)
+            size, _ = self._meta.pop(key)
+            self.size -= size
+            self._pinned.discard(key)
+
+    def __contains__(self, key):
+        with self._lock:
+            if dict.__contains__(self, key):
+                return True
+            loaded = self._load(key)
+            if loaded is None:
+                return False
+            self.loads += 1
+            self._add(key, *loaded)
+            return True
+
+    def copy(self):
+        # Copies and pickles are of what is loaded, as a plain defaultdict
+        return defaultdict(dict, dict.items(self))
+
+    __copy__ = copy
+
+    def __reduce__(self):
+        return defaultdict, (dict, dict(dict.items(self)))
+
+    def pin(self, key):
+        with self._lock:
+            self._pinned.add(key)
+
+    def unpin(self, keys):
+        with self._lock:
+            self._pinned.difference_update(keys)
+
+    def set_size(self, key, size):
+        with self._lock:
+            meta = self._meta.get(key)
+            if meta is not None:
+                self.size += size - meta[0]
+                meta[0] = size
+
+    def _evict(self):
+        if self.size <= self.max_bytes:
+            return
+        idle_since = time.monotonic() - self.min_idle
+        for key, (size, last_used) in list(self._meta.items()):
+            if self.size <= self.max_bytes or last_used > idle_since:
+                break
+            if key in self._pinned:
+                continue
+            dict.__delitem__(self, key)
+            del self._meta[key]
+            self.size -= size
+            self.evictions += 1
+            if self._on_evict:
+                self._on_evict(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._meta),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'loads': self.loads,
+                'evictions': self.evictions
+            }
+
+
+_SQLITE_HEADER = b'SQLite format 3\x00'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS user_data (id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS chat_data (id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS misc (key TEXT PRIMARY KEY, data BLOB NOT NULL);
+'''
+
+_CHAT_REPOS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS chat_repos (chat_id INTEGER NOT NULL, repo_id INTEGER NOT NULL,
+                                       flags INTEGER NOT NULL, truncation_limit INTEGER NOT NULL,
+                                       PRIMARY KEY (chat_id, repo_id));
+'''
+# Bumped when a migration of the sqlite database itself is needed.
+# 1 added chat_repos, 2 added the settings of each subscription to it
+_SCHEMA_VERSION = 2
+
+
+class SQLitePersistence(SnapshotFlushMixin, BasePersistence):
+    # Stores every user and chat in its own row, so that a flush only has to write the ones that changed.
+    # The dispatcher tells us which users and chats it touched through update_user_data and update_chat_data,
+    # and of those only the ones whose pickled data differs from what was last written are saved.
+    # With a cache_size, users and chats are only loaded when they are needed (see LazyRows),
+    # and the repositories of every chat are kept in chat_repos so that repo_index can be built without them.
+    def __init__(self, filename, cache_size=0):
+        super().__init__(store_user_data=True, store_chat_data=True)
+        self._init_flush()
+
+        self.filename = filename
+        self.cache_size = cache_size
+        self.user_data = None
+        self.chat_data = None
+        self.conversations = None
+        self.github_data = None
+
+        self._conn = None
+        # (table, key) -> digest of the pickle last written for it
+        self._digests = {}
+        self._dirty = {'user_data': set(), 'chat_data': set()}
+        self._lock = threading.Lock()
+        # The connection is shared between threads, but only one of them may use it at a time
+        self._conn_lock = threading.Lock()
+
+    def _connect(self, filename):
+        conn = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(_SCHEMA)
+        return conn
+
+    def _migrate(self):
+        # One time conversion of a database written by the pickle based Persistence
+        try:
+            with open(self.filename, 'rb') as f:
+                if f.read(len(_SQLITE_HEADER)) == _SQLITE_HEADER:
+                    return
+                f.seek(0)
+                old = pickle.load(f)
+        except FileNotFoundError:
+            return
+        except Exception:
+            raise TypeError("Something went wrong unpickling {}".format(self.filename))
+
+        self.logger.info('Migrating %s from pickle to sqlite', self.filename)
+        tmp_filename = self.filename + '.tmp'
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        conn = self._connect(tmp_filename)
+        with conn:
+            conn.execute('BEGIN')
+            for table in ('user_data', 'chat_data'):
+                conn.executemany(f'INSERT INTO {table} (id, data) VALUES (?, ?)',
+                                 ((key, pickle.dumps(data)) for key, data in old[table].items()))
+            conn.executemany('INSERT INTO misc (key, data) VALUES (?, ?)',
+                             ((key, pickle.dumps(old.get(key) or {})) for key in ('conversations', 'github_data')))
+        conn.close()
+        # The pickle is kept around, just in case
+        os.replace(self.filename, self.filename + '.pickle')
+        os.replace(tmp_filename, self.filename)
+
+    def _write_chat_repos(self, chat_id, data):
+        truncation_limit = data.get('truncation_limit', DEFAULT_TRUNCATION_LIMIT)
+        self._conn.execute('DELETE FROM chat_repos WHERE chat_id = ?', (chat_id,))
+        self._conn.executemany('INSERT INTO chat_repos (chat_id, repo_id, flags, truncation_limit) '
+                               'VALUES (?, ?, ?, ?)',
+                               ((chat_id, repo_id, repo.flags, truncation_limit)
+                                for repo_id, repo in data.get('repos', {}).items()))
+
+    def _upgrade(self):
+        version = self._conn.execute('PRAGMA user_version').fetchone()[0]
+        if version < 2:
+            with self._conn:
+                self._conn.execute('BEGIN')
+                self._conn.execute('DROP TABLE IF EXISTS chat_repos')
+                self._conn.execute(_CHAT_REPOS_SCHEMA)
+                for chat_id, blob in self._conn.execute('SELECT id, data FROM chat_data').fetchall():
+                    self._write_chat_repos(chat_id, pickle.loads(blob))
+        self._conn.execute(f'PRAGMA user_version = {_SCHEMA_VERSION}')
+
+    def load(self):
+        self._migrate()
+        self._conn = self._connect(self.filename)
+        self._upgrade()
+
+        if self.cache_size:
+            for table in ('user_data', 'chat_data'):
+                setattr(self, table, LazyRows(lambda key, table=table: self._load_entry(table, key), self.cache_size,
+                                              on_evict=lambda key, table=table: self._digests.pop((table, key), None)))
+            repo_index.rebuild_from(self._conn.execute('SELECT repo_id, chat_id, flags, truncation_limit '
+                                                       'FROM chat_repos'))
+        else:
+            for table in ('user_data', 'chat_data'):
+                data = defaultdict(dict)
+                for key, blob in self._conn.execute(f'SELECT id, data FROM {table}'):
+                    data[key] = pickle.loads(blob)
+                    self._digests[(table, key)] = hashlib.sha1(blob).digest()
+                setattr(self, table, data)
+            repo_index.rebuild(self.chat_data)
+
+        misc = dict(self._conn.execute('SELECT key, data FROM misc'))
+        for key, blob in misc.items():
+            self._digests[('misc', key)] = hashlib.sha1(blob).digest()
+        self.conversations = pickle.loads(misc['conversations']) if 'conversations' in misc else {}
+        self.github_data = pickle.loads(misc['github_data']) if 'github_data' in misc else {}
+        installation_registry.bind(self.github_data.setdefault('installations', {}))
+
+    def _load_entry(self, table, key):
+        with self._conn_lock:
+            row = self._conn.execute(f'SELECT data FROM {table} WHERE id = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        self._digests[(table, key)] = hashlib.sha1(row[0]).digest()
+        return pickle.loads(row[0]), len(row[0])
+
+    def load_row(self, table, key):
+        # Point lookup of what is currently stored for a single user or chat
+        with self._conn_lock:
+            row = self._conn.execute(f'SELECT data FROM {table} WHERE id = ?', (key,)).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    # The dispatcher gets the very same dicts instead of copies, since keeping two copies of everything around
+    # would only cost memory: they'd end up the same anyway once update_*_data is called for them.
+    def get_user_data(self):
+        if self.user_data is None:
+            self.load()
+        return self.user_data
+
+    def get_chat_data(self):
+        if self.chat_data is None:
+            self.load()
+        return self.chat_data
+
+    def get_conversations(self, name):
+        if self.conversations is None:
+            self.load()
+        return self.conversations.get(name, {}).copy()
+
+    def update_conversation(self, name, key, new_state):
+        self.conversations.setdefault(name, {})[key] = new_state
+
+    def _update(self, table, key, data):
+        with self._lock:
+            rows = getattr(self, table)
+            rows[key] = data
+            self._dirty[table].add(key)
+            if self.cache_size:
+                rows.pin(key)
+
+    def update_user_data(self, user_id, data):
+        self._update('user_data', user_id, data)
+
+    def update_chat_data(self, chat_id, data):
+        self._update('chat_data', chat_id, data)
+
+    def _take_snapshot(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, {'user_data': set(), 'chat_data': set()}
+        snapshot = {table: [(key, _snapshot(getattr(self, table)[key])) for key in keys]
+                    for table, keys in dirty.items()}
+        snapshot['misc'] = [('conversations', _snapshot(self.conversations)),
+                            ('github_data', _snapshot(self.github_data))]
+        return snapshot
+
+    def _write_snapshot(self, snapshot):
+        if self._conn is None:
+            return 0
+
+        changes = {}
+        for table, items in snapshot.items():
+            changes[table] = []
+            for key, data in items:
+                blob = pickle.dumps(data)
+                digest = hashlib.sha1(blob).digest()
+                if self._digests.get((table, key)) != digest:
+                    changes[table].append((key, blob, digest))
+
+        try:
+            with self._conn_lock, self._conn:
+                self._conn.execute('BEGIN')
+                for table, rows in changes.items():
+                    column = 'key' if table == 'misc' else 'id'
+                    self._conn.executemany(f'INSERT OR REPLACE INTO {table} ({column}, data) VALUES (?, ?)',
+                                           ((key, blob) for key, blob, _ in rows))
+                chats = dict(snapshot['chat_data'])
+                for chat_id, _, _ in changes['chat_data']:
+                    self._write_chat_repos(chat_id, chats[chat_id])
+        except sqlite3.Error:
+            # Make sure they are written next time
+            with self._lock:
+                for table in ('user_data', 'chat_data'):
+                    self._dirty[table].update(key for key, _ in snapshot[table])
+            raise
+
+        for table, rows in changes.items():
+            for key, blob, digest in rows:
+                self._digests[(table, key)] = digest
+                if self.cache_size and table != 'misc':
+                    getattr(self, table).set_size(key, len(blob))
+        if self.cache_size:
+            with self._lock:
+                for table in ('user_data', 'chat_data'):
+                    # Unless they were changed again in the meantime
+                    getattr(self, table).unpin({key for key, _ in snapshot[table]} - self._dirty[table])
+        return sum(len(blob) for rows in changes.values() for _, blob, _ in rows)
+
+
+def read_subscriptions(filename):
+    # (repo_id, chat_id, flags, truncation_limit) of every subscription stored by a SQLitePersistence,
+    # for processes that only need repo_index and leave the database to the one that owns it
+    conn = sqlite3.connect(f'file:{filename}?mode=ro', uri=True, timeout=30)
+    try:
+        return conn.execute('SELECT repo_id, chat_id, flags, truncation_limit FROM chat_repos').fetchall()
+    finally:
+        conn.close()
+
+
+def get_persistence(backend, filename):
+    if backend == 'pickle':
+        return Persistence(filename)
+    elif backend == 'sqlite':
+        return SQLitePersistence(filename, cache_size=PERSISTENCE_CACHE_SIZE)
+    raise ValueError(f'Unknown persistence backend {backend!r}')
@@ -0,0 +1,143 @@
+import logging
+import threading
+import time
+
+# Priorities of github api calls, lower goes first
+INTERACTIVE = 0
+BACKGROUND = 1
+
+
+class _Bucket:
+    __slots__ = ('remaining', 'reset', 'blocked_until', 'waiting')
+
+    def __init__(self):
+        # Unknown until the first response
+        self.remaining = None
+        self.reset = 0.0
+        # Set from Retry-After on secondary rate limits
+        self.blocked_until = 0.0
+        # Priority -> number of calls waiting
+        self.waiting = [0, 0]
+
+
+class RateLimiter:
+    # Keeps track of the rate limit of every set of credentials (the app, each installation and each user token)
+    # from the X-RateLimit headers, and holds calls back instead of letting them fail once it runs out.
+    # The last `reserve` calls before a reset are kept for interactive calls, and waiting interactive calls
+    # go before waiting background ones.
+    def __init__(self, reserve=100, max_wait=(10, 5 * 60)):
+        self.logger = logging.getLogger(self.__class__.__qualname__)
+
+        self.reserve = reserve
+        # Priority -> the longest a call waits before being sent anyway
+        self.max_wait = max_wait
+
+        self.waits = 0
+        self.retries = 0
+
+        self._buckets = {}
+        self._cond = threading.Condition()
+
+    def _wait_until(self, bucket, priority, now):
+        # Unix time the call has to wait for, or 0
+        if bucket.blocked_until > now:
+            return bucket.blocked_until
+        if bucket.remaining is not None and bucket.reset > now:
+            if bucket.remaining <= 0:
+                return bucket.reset
+            if priority == BACKGROUND and bucket.remaining <= self.reserve:
+                return bucket.reset
+        if priority == BACKGROUND and bucket.waiting[INTERACTIVE]:
+            # Checked again once the interactive calls went
+            return now + 1
+        return 0
+
+    def _bucket(self, key):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = _Bucket()
+        return bucket
+
+    def acquire(self, key, priority=INTERACTIVE, max_wait=None):
+        # Waits until the call may go ahead, or at most max_wait (the one of the priority by default).
+        # With the default the call goes anyway after that, with an explicit max_wait it returns False
+        # once that has passed instead, so that the caller can do without the call.
+        deadline = time.monotonic() + (self.max_wait[priority] if max_wait is None else max_wait)
+        with self._cond:
+            bucket = self._bucket(key)
+
+            bucket.waiting[priority] += 1
+            try:
+                waited = False
+                while True:
+                    now = time.time()
+                    until = self._wait_until(bucket, priority, now)
+                    timeout = min(until - now, deadline - time.monotonic())
+                    if not until or timeout <= 0:
+                        break
+                    if not waited:
+                        waited = True
+                        self.waits += 1
+                        self.logger.info('Rate limited on %s, waiting up to %.0f seconds', key, timeout)
+                    self._cond.wait(timeout)
+
+                if until and max_wait is not None:
+                    return False
+                if bucket.remaining is not None:
+                    bucket.remaining -= 1
+                return True
+            finally:
+                bucket.waiting[priority] -= 1
+                if priority == INTERACTIVE:
+                    self._cond.notify_all()
+
+    def poll(self, key, priority=INTERACTIVE):
+        # acquire() for callers that mustn't block: returns 0 if the call may go ahead,
+        # otherwise how many seconds to wait before polling again
+        with self._cond:
+            bucket = self._bucket(key)
+            now = time.time()
+            until = self._wait_until(bucket, priority, now)
+            if until:
+                return until - now
+            if bucket.remaining is not None:
+                bucket.remaining -= 1
+            return 0
+
+    def update(self, key, status_code, headers, body=b''):
+        # Takes the status, headers and body of a response (both requests' and tornado's headers do).
+        # Returns whether it was rate limited, in which case the call can be retried
+        now = time.time()
+        limited = False
+        with self._cond:
+            bucket = self._bucket(key)
+
+            if 'X-RateLimit-Remaining' in headers:
+                bucket.remaining = int(headers['X-RateLimit-Remaining'])
+                bucket.reset = float(headers.get('X-RateLimit-Reset', 0))
+
+            if status_code in (403, 429):
+                if 'Retry-After' in headers:
+                    bucket.blocked_until = now + int(headers['Retry-After'])
+                    limited = True
+                elif bucket.remaining == 0 and bucket.reset > now:
+                    limited = True
+                elif b'rate limit' in body.lower():
+                    # Secondary rate limit without Retry-After, github says to wait at least a minute
+                    bucket.blocked_until = now + 60
+                    limited = True
+
+            if limited:
+                self.retries += 1
+            self._cond.notify_all()
+        return limited
+
+    def stats(self):
+        with self._cond:
+            return {
+                'waits': self.waits,
+                'retries': self.retries,
+                'buckets': {key: {'remaining': bucket.remaining, 'reset': bucket.reset,
+                                  'blocked_until': bucket.blocked_until, 'waiting': list(bucket.waiting)}
+                            for key, bucket in self._buckets.items()}
+            }
@@ -0,0 +1,85 @@
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from bot import truncator
+from bot.const import RENDER_MAX_IN_FLIGHT, RENDER_WORKERS
+
+
+class RenderPool:
+    # Runs the CPU bound cleaning and truncation in worker processes, so that it is not limited by the GIL.
+    # When there are no workers, or all of them are busy, jobs are simply run in the calling thread.
+    def __init__(self, workers=0, max_in_flight=0):
+        self.logger = logging.getLogger(self.__class__.__qualname__)
+
+        self.workers = workers
+        self.max_in_flight = max_in_flight or 2 * workers
+
+        self.pooled = 0
+        self.local = 0
+        self.broken = 0
+
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(max(1, self.max_in_flight))
+        self._lock = threading.Lock()
+
+    def _new_executor(self):
+        # Forking a process that has threads running is asking for deadlocks
+        return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def start(self):
+        if self.workers:
+            self._executor = self._new_executor()
+
+    def stop(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+    def _run(self, function, *args):
+        executor = self._executor
+        if executor is None or not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.local += 1
+            return function(*args)
+
+        try:
+            result = executor.submit(function, *args).result()
+        except BrokenProcessPool:
+            # A worker died (killed, out of memory...). Replace the pool and do this one ourselves
+            self.logger.error('Render pool broke, restarting it', exc_info=1)
+            with self._lock:
+                self.broken += 1
+                self.local += 1
+                if self._executor is executor:
+                    self._executor = self._new_executor()
+            executor.shutdown(wait=False)
+            return function(*args)
+        finally:
+            self._slots.release()
+
+        with self._lock:
+            self.pooled += 1
+        return result
+
+    def clean_tokens(self, html):
+        return self._run(truncator.clean_tokens, html)
+
+    def truncate_many(self, html, truncated_message, suffix, limits, max_entities=None):
+        return self._run(truncator.truncate_many, html, truncated_message, suffix, limits, max_entities)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers if self._executor is not None else 0,
+                'max_in_flight': self.max_in_flight,
+                'pooled': self.pooled,
+                'local': self.local,
+                'broken': self.broken
+            }
+
+
+render_pool = RenderPool(RENDER_WORKERS, RENDER_MAX_IN_FLIGHT)
@@ -1,17 +1,77 @@
-from dataclasses import dataclass
+import sys
+
+# The notification settings of a repository and whether they are on by default, in bit order
+SETTINGS = (
+    ('issues', True),
+    ('issue_comments', True),
+    ('pulls', True),
+    ('pull_comments', True),
+    ('pull_reviews', True),
+    ('pull_review_comments', True),
+    ('wiki_pages', False),
+    ('push', False),
+    ('push_main', True),
+    ('commit_comments', True),
+)
+# Setting name -> its bit in Repo.flags
+FLAGS = {name: 1 << bit for bit, (name, _) in enumerate(SETTINGS)}
+DEFAULT_FLAGS = sum(FLAGS[name] for name, default in SETTINGS if default)
+
+
+def _setting(name):
+    mask = FLAGS[name]
+
+    def get(self):
+        return bool(self.flags & mask)
+
+    def set(self, value):
+        self.flags = self.flags | mask if value else self.flags & ~mask
+
+    return property(get, set)
 
 
-@dataclass
 class Repo:
-    name: str
-    id: int
-    issues: bool = True
-    issue_comments: bool = True
-    pulls: bool = True
-    pull_comments: bool = True
-    pull_reviews: bool = True
-    pull_review_comments: bool = True
-    wiki_pages: bool = False
-    push: bool = False
-    push_main: bool = True
-    commit_comments: bool = True
+    # One of these is stored for every repository of every chat, so it is kept small:
+    # the settings are bits of a single int and the names are interned.
+    __slots__ = ('name', 'id', 'flags')
+
+    def __init__(self, name, id, **settings):
+        self.name = sys.intern(name)
+        self.id = id
+        self.flags = DEFAULT_FLAGS
+        for key, value in settings.items():
+            if key not in FLAGS:
+                raise TypeError(f'Repo() got an unexpected keyword argument {key!r}')
+            setattr(self, key, value)
+
+    issues = _setting('issues')
+    issue_comments = _setting('issue_comments')
+    pulls = _setting('pulls')
+    pull_comments = _setting('pull_comments')
+    pull_reviews = _setting('pull_reviews')
+    pull_review_comments = _setting('pull_review_comments')
+    wiki_pages = _setting('wiki_pages')
+    push = _setting('push')
+    push_main = _setting('push_main')
+    commit_comments = _setting('commit_comments')
+
+    def __getstate__(self):
+        return self.name, self.id, self.flags
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # Pickled back when Repo was a dataclass
+            state = dict(state)
+            self.__init__(state.pop('name'), state.pop('id'), **state)
+        else:
+            name, self.id, self.flags = state
+            self.name = sys.intern(name)
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return (self.name, self.id, self.flags) == (other.name, other.id, other.flags)
+
+    def __repr__(self):
+        settings = ', '.join(f'{name}={getattr(self, name)}' for name, _ in SETTINGS)
+        return f'Repo(name={self.name!r}, id={self.id!r}, {settings})'
@@ -0,0 +1,106 @@
+import threading
+from array import array
+from itertools import compress
+
+from bot.const import DEFAULT_TRUNCATION_LIMIT
+from bot.repo import DEFAULT_FLAGS
+
+
+class _Subscriptions:
+    # The chats subscribed to one repository, stored as columns
+    __slots__ = ('chat_ids', 'flags', 'truncation_limits', 'positions', 'selectors')
+
+    def __init__(self):
+        self.chat_ids = array('q')
+        self.flags = array('H')
+        self.truncation_limits = array('l')
+        # chat_id -> its index in the columns
+        self.positions = {}
+        # Settings mask -> one byte per chat saying whether it wants events needing that mask.
+        # There are only a few masks per repository, and these make filtering a single pass in C.
+        self.selectors = {}
+
+    def set(self, chat_id, flags, truncation_limit):
+        position = self.positions.get(chat_id)
+        if position is None:
+            self.positions[chat_id] = len(self.chat_ids)
+            self.chat_ids.append(chat_id)
+            self.flags.append(flags)
+            self.truncation_limits.append(truncation_limit)
+        else:
+            self.flags[position] = flags
+            self.truncation_limits[position] = truncation_limit
+        self.selectors.clear()
+
+    def remove(self, chat_id):
+        position = self.positions.pop(chat_id, None)
+        if position is None:
+            return
+        # Move the last chat into the hole
+        last = len(self.chat_ids) - 1
+        if position != last:
+            self.chat_ids[position] = self.chat_ids[last]
+            self.flags[position] = self.flags[last]
+            self.truncation_limits[position] = self.truncation_limits[last]
+            self.positions[self.chat_ids[position]] = position
+        del self.chat_ids[last], self.flags[last], self.truncation_limits[last]
+        self.selectors.clear()
+
+    def targets(self, mask):
+        selector = self.selectors.get(mask)
+        if selector is None:
+            selector = self.selectors[mask] = bytes(bool(flags & mask) for flags in self.flags)
+        return list(compress(zip(self.chat_ids, self.truncation_limits), selector))
+
+
+# Maps repository ids to the chats subscribed to them along with their settings,
+# so that GitHub events don't have to look at the chat_data of every chat
+class RepoIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._repos = {}
+
+    def rebuild(self, chat_data):
+        self.rebuild_from((repo_id, chat_id, repo.flags, data.get('truncation_limit', DEFAULT_TRUNCATION_LIMIT))
+                          for chat_id, data in chat_data.items()
+                          for repo_id, repo in data.get('repos', {}).items())
+
+    def rebuild_from(self, subscriptions):
+        # Takes (repo_id, chat_id, flags, truncation_limit) tuples
+        repos = {}
+        for repo_id, chat_id, flags, truncation_limit in subscriptions:
+            if repo_id not in repos:
+                repos[repo_id] = _Subscriptions()
+            repos[repo_id].set(chat_id, flags, truncation_limit)
+
+        with self._lock:
+            self._repos = repos
+
+    def add(self, repo_id, chat_id, flags=DEFAULT_FLAGS, truncation_limit=DEFAULT_TRUNCATION_LIMIT):
+        # Also used to update the settings of an existing subscription
+        with self._lock:
+            if repo_id not in self._repos:
+                self._repos[repo_id] = _Subscriptions()
+            self._repos[repo_id].set(chat_id, flags, truncation_limit)
+
+    def remove(self, repo_id, chat_id):
+        with self._lock:
+            subscriptions = self._repos.get(repo_id)
+            if subscriptions is not None:
+                subscriptions.remove(chat_id)
+                if not subscriptions.positions:
+                    del self._repos[repo_id]
+
+    def chats(self, repo_id):
+        with self._lock:
+            subscriptions = self._repos.get(repo_id)
+            return list(subscriptions.chat_ids) if subscriptions is not None else []
+
+    def targets(self, repo_id, mask):
+        # (chat_id, truncation_limit) of the chats that have any of the settings in mask turned on
+        with self._lock:
+            subscriptions = self._repos.get(repo_id)
+            return subscriptions.targets(mask) if subscriptions is not None else []
+
+
+repo_index = RepoIndex()
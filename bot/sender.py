@@ -0,0 +1,183 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+
+from telegram.error import RetryAfter, TelegramError
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        # Seconds until a token is available
+        with self._lock:
+            self._refill()
+            return max(0.0, (1 - self.tokens) / self.rate)
+
+    def consume(self):
+        # Takes a token, going into debt if none are available.
+        # Returns how long the caller has to wait before it may use it.
+        with self._lock:
+            self._refill()
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+    @property
+    def full(self):
+        with self._lock:
+            self._refill()
+            return self.tokens >= self.capacity
+
+
+class MessageScheduler:
+    def __init__(self, bot, workers=8, global_rate=30, chat_rate=1):
+        self.logger = logging.getLogger(self.__class__.__qualname__)
+
+        self.bot = bot
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.global_bucket = TokenBucket(global_rate)
+
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+        # chat_id -> pending messages. A chat is in here iff it is either in the heap or being sent to
+        self._queues = {}
+        self._chat_buckets = {}
+        # (ready_at, seq, chat_id) for chats waiting on a worker
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._last_prune = time.monotonic()
+        self.running = False
+
+    def start(self):
+        self.running = True
+        for i in range(self.workers):
+            thr = threading.Thread(target=self._worker, name=f'message_scheduler_{i}', daemon=True)
+            thr.start()
+            self._threads.append(thr)
+
+    def stop(self):
+        with self._cond:
+            self.running = False
+            self._cond.notify_all()
+        for thr in self._threads:
+            thr.join()
+        self._threads = []
+
+        pending = sum(len(queue) for queue in self._queues.values())
+        if pending:
+            self.logger.warning('Stopped with %d messages still pending', pending)
+
+    def send_message(self, chat_id, text, callback=None, **kwargs):
+        # callback is called without arguments once the message was sent, or failed for good.
+        # Messages still pending when the scheduler stops never get theirs
+        with self._cond:
+            queue = self._queues.get(chat_id)
+            if queue is None:
+                queue = self._queues[chat_id] = deque()
+                self._schedule(chat_id)
+            queue.append((dict(text=text, **kwargs), callback))
+
+    def _schedule(self, chat_id, ready_at=None):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate)
+        if ready_at is None:
+            ready_at = time.monotonic() + bucket.delay()
+        heapq.heappush(self._heap, (ready_at, next(self._seq), chat_id))
+        self._cond.notify()
+
+    def _prune_buckets(self):
+        for chat_id in [chat_id for chat_id, bucket in self._chat_buckets.items()
+                        if chat_id not in self._queues and bucket.full]:
+            del self._chat_buckets[chat_id]
+        self._last_prune = time.monotonic()
+
+    def _next(self):
+        with self._cond:
+            while self.running:
+                if self._heap:
+                    timeout = self._heap[0][0] - time.monotonic()
+                    if timeout <= 0:
+                        _, _, chat_id = heapq.heappop(self._heap)
+                        return chat_id, self._queues[chat_id][0], self._chat_buckets[chat_id]
+                    self._cond.wait(timeout)
+                else:
+                    self._cond.wait()
+
+    def _worker(self):
+        while True:
+            job = self._next()
+            if job is None:
+                return
+            chat_id, (kwargs, callback), bucket = job
+
+            time.sleep(self.global_bucket.consume())
+            bucket.consume()
+
+            retry_after = None
+            failed = False
+            try:
+                self.bot.send_message(chat_id=chat_id, **kwargs)
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                self.logger.warning('Flood control for chat %s, retrying in %s sec', chat_id, retry_after)
+            except TelegramError:
+                failed = True
+                self.logger.error('error while sending github update', exc_info=1)
+            except Exception:
+                # Anything else (e.g. from the request layer) mustn't take the worker and the chat's queue with it
+                failed = True
+                self.logger.exception('Unexpected error while sending github update')
+
+            with self._cond:
+                queue = self._queues[chat_id]
+                if retry_after is not None:
+                    self.retried += 1
+                    self._schedule(chat_id, time.monotonic() + retry_after)
+                    continue
+
+                if failed:
+                    self.failed += 1
+                else:
+                    self.sent += 1
+                queue.popleft()
+                if queue:
+                    self._schedule(chat_id)
+                else:
+                    del self._queues[chat_id]
+                    if time.monotonic() - self._last_prune > 60:
+                        self._prune_buckets()
+
+            if callback is not None:
+                try:
+                    callback()
+                except Exception:
+                    self.logger.exception('Error in callback of message to chat %s', chat_id)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'pending': sum(len(queue) for queue in self._queues.values()),
+                'chats': len(self._queues),
+                'sent': self.sent,
+                'failed': self.failed,
+                'retried': self.retried
+            }
@@ -4,10 +4,12 @@ from uuid import uuid4
 from telegram import Chat, InlineQueryResultArticle, InputTextMessageContent, ParseMode
 from telegram.ext import Dispatcher, InlineQueryHandler, CommandHandler
 
+from bot.catalog import repo_catalogs
 from bot.const import DEFAULT_TRUNCATION_LIMIT
 from bot.github import github_api
 from bot.menu import Button, Menu, BackButton, reply_menu, MenuHandler, ToggleButton, SetButton
 from bot.repo import Repo
+from bot.repoindex import repo_index
 from bot.utils import encode_data_link, decode_first_data_entity
 
 BACK = '⬅ Back'
@@ -67,7 +69,9 @@ def settings_buttons(update, context):
 
 def settings_set_data(_, context):
     if context.key == 'login' and context.value is None:
-        del context.user_data['access_token']
+        access_token = context.user_data.pop('access_token')
+        github_api.forget_user(access_token)
+        repo_catalogs.invalidate(access_token)
 
 
 settings_menu = Menu(
@@ -160,9 +164,12 @@ def repo_set_data(update, context):
 
     if context.key == 'remove':
         del context.chat_data['repos'][repo_id]
+        repo_index.remove(repo_id, update.effective_chat.id)
     else:
         repo = context.chat_data['repos'][repo_id]
         setattr(repo, context.key, context.value)
+        repo_index.add(repo_id, update.effective_chat.id, repo.flags,
+                       context.chat_data.get('truncation_limit', DEFAULT_TRUNCATION_LIMIT))
 
 
 repo_menu = Menu(
@@ -197,6 +204,9 @@ def chat_buttons(update, context):
 
 def chat_set_data(update, context):
     context.chat_data[context.key] = context.value
+    if context.key == 'truncation_limit':
+        for repo_id, repo in context.chat_data.get('repos', {}).items():
+            repo_index.add(repo_id, update.effective_chat.id, repo.flags, context.value)
 
 
 chat_settings_menu = Menu(
@@ -215,33 +225,15 @@ def settings_command(update, context):
 
 
 def inline_add_repo(update, context):
-    offset = update.inline_query.offset
-    installation_offset, repo_offset = -1, -1
-    if offset:
-        installation_offset, _, repo_offset = offset.partition('|')
-        installation_offset, repo_offset = int(installation_offset), int(repo_offset)
+    offset = int(update.inline_query.offset or 0)
 
     access_token = context.user_data.get('access_token')
 
     results = []
     if access_token:
-        filtered_repositories = []
         search = context.match.group(1).strip()
-        installations = github_api.get_installations_for_user(access_token)
-        for installation_index, installation in enumerate(installations):
-            if installation_index <= installation_offset:
-                continue
-            repositories = github_api.get_repositories_for_installation(installation['id'],
-                                                                        access_token)
-            for repo_index, repo in enumerate(repositories):
-                if repo_index <= repo_offset:
-                    continue
-                if repo['full_name'].startswith(search) or repo['name'].startswith(search):
-                    filtered_repositories.append(repo)
-                if len(filtered_repositories) >= 50:
-                    break
-            if len(filtered_repositories) >= 50:
-                break
+        # Answered from memory, the installations and repositories are only fetched when the catalog is missing or stale
+        filtered_repositories = repo_catalogs.get(access_token).search(search, offset, limit=50)
 
         results = []
         for repo in filtered_repositories:
@@ -249,7 +241,7 @@ def inline_add_repo(update, context):
                 id=repo['id'],
                 title=repo['full_name'],
                 description='Add this repository',
-                thumb_url=repo['owner']['avatar_url'],
+                thumb_url=repo['avatar_url'],
                 input_message_content=InputTextMessageContent(
                     message_text=f'/add_repo {encode_data_link(repo["id"])}<a href="{repo["html_url"]}">{repo["full_name"]}</a>',
                     parse_mode=ParseMode.HTML
@@ -273,7 +265,7 @@ def inline_add_repo(update, context):
         switch_pm_parameter='help',
         cache_time=15,
         is_personal=True,
-        next_offset=f'{installation_index-1}|{repo_index}' if results else ''
+        next_offset=str(offset + len(results)) if len(results) >= 50 else ''
     )
 
 
@@ -286,9 +278,15 @@ def add_repo_command(update, context):
             'Please use /settings to add repositories, instead of using the command directly.')
         return
 
-    repository = github_api.get_repository(repo_id, access_token=access_token)
+    # Usually in the catalog the inline query was just answered from
+    catalog = repo_catalogs.peek(access_token)
+    repository = catalog.repository(repo_id) if catalog is not None else None
+    if repository is None:
+        repository = github_api.get_repository(repo_id, access_token=access_token)
 
-    repos[repository['id']] = Repo(name=repository['full_name'], id=repository['id'])
+    repo = repos[repository['id']] = Repo(name=repository['full_name'], id=repository['id'])
+    repo_index.add(repo.id, update.effective_chat.id, repo.flags,
+                   context.chat_data.get('truncation_limit', DEFAULT_TRUNCATION_LIMIT))
 
     context.menu_stack = ['settings']
     reply_menu(update, context, repos_menu)
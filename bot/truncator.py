@@ -1,11 +1,19 @@
 import itertools
+import logging
+import threading
+from html import unescape
 
 import html5lib
 import telegram
-from bleach.sanitizer import Cleaner
+from bleach.sanitizer import ALLOWED_PROTOCOLS, Cleaner
 from html5lib.filters.base import Filter
 from html5lib.serializer import HTMLSerializer
 
+from bot import fasthtml
+from bot.const import TRUNCATOR_ENGINE
+
+logger = logging.getLogger(__name__)
+
 
 class _GithubFilter(Filter):
     def __iter__(self):
@@ -67,10 +75,7 @@ class _GithubFilter(Filter):
                 yield token
 
 
-# "This cleaner is not designed to use to transform content to be used in non-web-page contexts."
-# ...is a warning from the bleach docs... that we are gonna totally ignore...
-# TODO: THIS IS NOT THREADSAFE
-github_cleaner = Cleaner(
+_CLEANER_KWARGS = dict(
     tags=[
         'a', 'b', 'code', 'em', 'i', 'pre', 'strong',
         'li', 'input', 'blockquote', 'p', 'hr'  # Stripped in _GithubFilter
@@ -86,6 +91,80 @@ github_cleaner = Cleaner(
 )
 
 
+class _TokenCollector:
+    # Stands in for the serializer of a Cleaner so that cleaning returns the token stream
+    # instead of a string that would just have to be parsed again before truncating.
+    # The tokens are fixed up to look like those of a fresh parse of the cleaned html:
+    # bleach leaves entities and attribute values unresolved, and a parser drops a newline right after <pre>.
+    def __init__(self, resolve_entities=True):
+        self.resolve_entities = resolve_entities
+
+    def render(self, stream):
+        tokens = []
+        previous = None
+        for token in stream:
+            if not self.resolve_entities:
+                pass
+            elif token['type'] == 'Entity':
+                token = {'type': 'Characters', 'data': unescape(f'&{token["name"]};')}
+            elif token['type'] in ('StartTag', 'EmptyTag') and token['data']:
+                token['data'] = {key: unescape(value) for key, value in token['data'].items()}
+
+            if (previous and previous['type'] == 'StartTag' and previous['name'] == 'pre' and
+                    token['type'] in ('Characters', 'SpaceCharacters') and token['data'].startswith('\n')):
+                token = dict(token, data=token['data'][1:])
+
+            if token['type'] not in ('Characters', 'SpaceCharacters') or token['data']:
+                tokens.append(token)
+            previous = token
+        return tokens
+
+
+def _strip_newlines(tokens):
+    # Token stream equivalent of str.strip('\n')
+    tokens = list(tokens)
+    for index, method in ((0, str.lstrip), (-1, str.rstrip)):
+        while tokens and tokens[index]['type'] in ('Characters', 'SpaceCharacters'):
+            data = method(tokens[index]['data'], '\n')
+            if data:
+                tokens[index] = dict(tokens[index], data=data)
+                break
+            del tokens[index]
+    return tokens
+
+
+class _LocalCleaner(threading.local):
+    # A Cleaner is not threadsafe, so every thread (and every render process) gets its own
+    def __init__(self, serializer=None):
+        self.cleaner = Cleaner(**_CLEANER_KWARGS)
+        if serializer is not None:
+            self.cleaner.serializer = serializer
+
+    def clean(self, html):
+        return self.cleaner.clean(html)
+
+
+# "This cleaner is not designed to use to transform content to be used in non-web-page contexts."
+# ...is a warning from the bleach docs... that we are gonna totally ignore...
+github_cleaner = _LocalCleaner()
+
+github_token_cleaner = _LocalCleaner(_TokenCollector())
+
+
+def _html5lib_clean_tokens(html):
+    return _strip_newlines(github_token_cleaner.clean(html) or [])
+
+
+def _htmlparser_clean_tokens(html):
+    stream = fasthtml.SanitizerFilter(fasthtml.parse_fragment(html),
+                                      tags=_CLEANER_KWARGS['tags'],
+                                      attributes=_CLEANER_KWARGS['attributes'],
+                                      protocols=_CLEANER_KWARGS.get('protocols', ALLOWED_PROTOCOLS))
+    for filter_class in _CLEANER_KWARGS['filters']:
+        stream = filter_class(stream)
+    return _strip_newlines(_TokenCollector(resolve_entities=False).render(stream))
+
+
 class TelegramTruncator(Filter):
     def __init__(self, source,
                  truncated_message,
@@ -145,11 +224,140 @@ class TelegramTruncator(Filter):
         yield from iter(self.suffix)
 
 
-def truncate(html, truncated_message, suffix, max_entities=None, max_length=None):
+def _html5lib_parse_fragment(html):
     walker = html5lib.getTreeWalker('etree')
-    html_stream = walker(html5lib.parseFragment(html, treebuilder='etree'))
-    truncated_message_stream = walker(html5lib.parseFragment(truncated_message, treebuilder='etree'))
-    suffix_stream = walker(html5lib.parseFragment(suffix, treebuilder='etree'))
-    truncated = TelegramTruncator(html_stream, truncated_message=truncated_message_stream, suffix=suffix_stream,
+    return list(walker(html5lib.parseFragment(html, treebuilder='etree')))
+
+
+_ENGINES = {
+    'html5lib': {'parse_fragment': _html5lib_parse_fragment, 'clean_tokens': _html5lib_clean_tokens},
+    'htmlparser': {'parse_fragment': fasthtml.parse_fragment, 'clean_tokens': _htmlparser_clean_tokens},
+}
+
+# Number of inputs compared in differential mode, and how many of them diverged
+differential_checks = 0
+differential_divergences = 0
+
+
+def _render_tokens(tokens):
+    return HTMLSerializer().render(tokens)
+
+
+def _compare_engines(function, html):
+    expected = _ENGINES['html5lib'][function](html)
+    actual = _ENGINES['htmlparser'][function](html)
+    expected_html, actual_html = _render_tokens(expected), _render_tokens(actual)
+    return expected, None if expected_html == actual_html else (expected_html, actual_html)
+
+
+def _run_engine(function, html):
+    global differential_checks, differential_divergences
+
+    if TRUNCATOR_ENGINE != 'differential':
+        return _ENGINES[TRUNCATOR_ENGINE][function](html)
+
+    # Use html5lib, but check whether htmlparser would have done the same
+    tokens, divergence = _compare_engines(function, html)
+    differential_checks += 1
+    if divergence:
+        differential_divergences += 1
+        logger.warning('htmlparser diverged from html5lib in %s (%d/%d). Input: %r html5lib: %r htmlparser: %r',
+                       function, differential_divergences, differential_checks, html, *divergence)
+    return tokens
+
+
+def compare_engines(corpus):
+    # Runs both engines on every html string in corpus and returns the ones they disagree on
+    # as a list of (function, html, html5lib output, htmlparser output)
+    divergences = []
+    for html in corpus:
+        for function in ('parse_fragment', 'clean_tokens'):
+            _, divergence = _compare_engines(function, html)
+            if divergence:
+                divergences.append((function, html, *divergence))
+    return divergences
+
+
+def parse_fragment(html):
+    return _run_engine('parse_fragment', html)
+
+
+def clean_tokens(html):
+    return _run_engine('clean_tokens', html)
+
+
+def _tokens(html):
+    if not html:
+        return []
+    return parse_fragment(html) if isinstance(html, str) else html
+
+
+def truncate(html, truncated_message, suffix, max_entities=None, max_length=None):
+    truncated = TelegramTruncator(parse_fragment(html),
+                                  truncated_message=parse_fragment(truncated_message),
+                                  suffix=parse_fragment(suffix),
                                   max_entities=max_entities, max_length=max_length)
     return HTMLSerializer().render(truncated).strip('\n')
+
+
+def truncate_many(html, truncated_message, suffix, limits, max_entities=None):
+    # Same as calling truncate() once per limit, but the html is only parsed once
+    # and the cut points for every limit are found in a single pass over the tokens.
+    # Any of html, truncated_message and suffix may also be an already parsed list of tokens.
+    tokens = _tokens(html)
+    truncated_message = _tokens(truncated_message)
+    suffix = _tokens(suffix)
+
+    reserved_entities = 0
+    reserved_length = 0
+    for token in itertools.chain(truncated_message, suffix):
+        if token['type'] == 'StartTag':
+            reserved_entities += 1
+        elif token['type'] in ('Characters', 'SpaceCharacters'):
+            reserved_length += len(token['data'])
+
+    max_entities = (max_entities or telegram.constants.MAX_MESSAGE_ENTITIES) - reserved_entities
+    # (max length, limit), shortest first
+    pending = sorted([((limit or telegram.constants.MAX_MESSAGE_LENGTH) - reserved_length, limit)
+                      for limit in set(limits)], key=lambda item: item[0])
+
+    cuts = {}
+    entity_count = 0
+    current_length = 0
+    current_tag_stack = []
+    for index, token in enumerate(tokens):
+        if not pending:
+            break
+        if entity_count >= max_entities:
+            for _, limit in pending:
+                cuts[limit] = (index, None, list(current_tag_stack))
+            pending = []
+            break
+        if token['type'] in ('Characters', 'SpaceCharacters'):
+            new_length = current_length + len(token['data'])
+            while pending and new_length > pending[0][0]:
+                max_length, limit = pending.pop(0)
+                cuts[limit] = (index, token['data'][:max_length - current_length], list(current_tag_stack))
+            current_length = new_length
+        elif token['type'] == 'EmptyTag':
+            entity_count += 1
+        elif token['type'] == 'StartTag':
+            entity_count += 1
+            current_tag_stack.append(token['name'])
+        elif token['type'] == 'EndTag':
+            current_tag_stack.pop()
+
+    serializer = HTMLSerializer()
+    results = {}
+    for _, limit in pending:
+        results[limit] = serializer.render(itertools.chain(tokens, suffix)).strip('\n')
+    for limit, (index, data, tag_stack) in cuts.items():
+        stream = itertools.chain(
+            tokens[:index],
+            [{'type': 'Characters', 'data': data}] if data is not None else [],
+            ({'type': 'EndTag', 'name': tag} for tag in reversed(tag_stack)),
+            truncated_message,
+            suffix
+        )
+        results[limit] = serializer.render(stream).strip('\n')
+    return results
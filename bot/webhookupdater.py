@@ -1,7 +1,9 @@
+import asyncio
 import hashlib
 import hmac
 import json
 import logging
+import time
 from threading import Thread
 from typing import Dict
 
@@ -11,8 +13,12 @@ from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
 from tornado.web import Application, RequestHandler, HTTPError
 
-from bot.const import GITHUB_WEBHOOK_SECRET, SERVER_HOSTNAME_PATTERN, SERVER_PORT, TELEGRAM_WEBHOOK_URL, HMAC_SECRET
+from bot.asyncgithubapi import async_github_api
+from bot.const import (GITHUB_WEBHOOK_SECRET, SERVER_HOSTNAME_PATTERN, SERVER_PORT, TELEGRAM_WEBHOOK_URL, HMAC_SECRET,
+                       WEBHOOK_DEDUP_WINDOW)
+from bot.dedup import delivery_dedup
 from bot.githubupdates import GithubUpdate, GithubAuthUpdate
+from bot.journal import webhook_journal
 from bot.utils import secure_decode_64, HMACException
 
 
@@ -24,14 +30,23 @@ class BaseWebhookHandler(RequestHandler):
         super().__init__(*args, **kwargs)
         self.logger = logging.getLogger(self.__class__.__qualname__)
 
-    def post(self):
+    async def post(self):
         self.logger.debug('Webhook triggered')
         self.validate()
+        if not self.should_process():
+            self.set_status(200)
+            return
         json_string = self.request.body.decode('utf-8')
         data = json.loads(json_string)
         self.set_status(200)
         self.logger.debug('Webhook received data: ' + json_string)
-        self.process_data(data)
+        result = self.process_data(data)
+        # Lets process_data hold back the response until it is done with something
+        if result is not None:
+            await result
+
+    def should_process(self):
+        return True
 
     def process_data(self, data: Dict):
         raise NotImplementedError
@@ -66,15 +81,39 @@ class TelegramWebhookHandler(BaseWebhookHandler):
 # noinspection PyAbstractClass
 class GithubWebhookHandler(BaseWebhookHandler):
     update_queue = None
+    split = False
 
     # noinspection PyMethodOverriding
-    def initialize(self, update_queue):
+    def initialize(self, update_queue, split=False):
         self.update_queue = update_queue
+        # Whether delivery worker processes handle the deliveries for repositories (see bot.worker)
+        self.split = split
 
-    def process_data(self, data):
+    def should_process(self):
+        # Checked before decoding anything, so that redeliveries are as cheap as possible
+        guid = self.request.headers.get('X-GitHub-Delivery')
+        if guid and delivery_dedup.check(guid):
+            self.logger.info('Ignoring duplicate delivery %s', guid)
+            return False
+        return True
+
+    async def process_data(self, data):
         guid = self.request.headers.get('X-GitHub-Delivery')
         event = self.request.headers.get('X-GitHub-Event')
-        update = GithubUpdate(data, guid, event)
+        repo_id = (data.get('repository') or {}).get('id')
+        # Only acknowledge the delivery once it is in the journal, so that it survives a restart
+        try:
+            journal_id = await asyncio.wrap_future(webhook_journal.append(guid, event,
+                                                                          self.request.body.decode('utf-8'), repo_id))
+        except Exception:
+            # Github will redeliver it after an error, which should not be seen as a duplicate
+            if guid:
+                delivery_dedup.forget(guid)
+            raise
+        if self.split and repo_id is not None:
+            # Picked up from the journal by a delivery worker
+            return
+        update = GithubUpdate(data, guid, event, journal_id=journal_id)
         self.logger.debug('Received GithubUpdate %s with GUID %s on Webhook', update.event, update.guid)
         self.update_queue.put(update)
 
@@ -133,8 +172,9 @@ class GithubAuthHandler(RequestHandler):
 
 
 class WebhookUpdater(object):
-    def __init__(self, token, updater_kwargs=None):
+    def __init__(self, token, updater_kwargs=None, split=False):
         self.logger = logging.getLogger(self.__class__.__qualname__)
+        self.split = split
 
         if updater_kwargs is None:
             updater_kwargs = {}
@@ -154,7 +194,7 @@ class WebhookUpdater(object):
             ), (
                 r'/github/webhook/?',
                 GithubWebhookHandler,
-                {'update_queue': self.update_queue}
+                {'update_queue': self.update_queue, 'split': split}
             ), (
                 r'/github/auth',
                 GithubAuthHandler,
@@ -169,13 +209,27 @@ class WebhookUpdater(object):
         self.logger.debug('Webhook Server started.')
         self.http_server.listen(SERVER_PORT)
         self.http_server_loop = IOLoop.current()
+        async_github_api.start(self.http_server_loop)
         self.http_server_loop.start()
+        async_github_api.stop()
         self.logger.debug('Webhook Server stopped.')
 
     def signal_handler(self, *_):
         self.http_server_loop.add_callback(self.http_server_loop.stop)
 
+    def _replay_journal(self):
+        # The delivery workers replay the rest themselves
+        pending = webhook_journal.pending(without_repository=self.split)
+        if pending:
+            self.logger.info('Replaying %d unfinished github deliveries', len(pending))
+        for journal_id, guid, event, body in pending:
+            self.update_queue.put(GithubUpdate(json.loads(body), guid, event, journal_id=journal_id))
+
     def start(self):
+        delivery_dedup.load(webhook_journal.recent_guids(time.time() - WEBHOOK_DEDUP_WINDOW))
+        self._replay_journal()
+        webhook_journal.start()
+
         self.updater.job_queue.start()
         self.updater.running = True
         # noinspection PyProtectedMember
@@ -0,0 +1,113 @@
+import json
+import logging
+import multiprocessing
+import sqlite3
+import time
+from queue import Queue
+
+from telegram import Bot
+from telegram.ext import CallbackContext, Dispatcher
+from telegram.utils.request import Request
+
+from bot.const import (TELEGRAM_BOT_TOKEN, DATABASE_FILE, SEND_WORKERS, SEND_GLOBAL_RATE, SEND_CHAT_RATE,
+                       GITHUB_WORKERS, GITHUB_QUEUE_SIZE, DELIVERY_POLL_INTERVAL, DELIVERY_SUBSCRIPTIONS_REFRESH)
+from bot.executor import KeyedExecutor
+from bot.github import GithubHandler
+from bot.githubupdates import GithubUpdate
+from bot.journal import webhook_journal
+from bot.persistence import read_subscriptions
+from bot.render import render_pool
+from bot.repoindex import repo_index
+from bot.sender import MessageScheduler
+
+
+def _error_handler(update, context: CallbackContext):
+    logging.warning('Update "%s" caused error "%s"' % (update, context.error))
+
+
+def run(partition, partitions, stop):
+    # Handles the github deliveries for the repositories in one partition, taking them from the webhook journal
+    # that the webhook server writes them to. Runs in a process of its own, see DeliveryWorkers.
+    logger = logging.getLogger(f'DeliveryWorker{partition}')
+
+    bot = Bot(TELEGRAM_BOT_TOKEN, request=Request(con_pool_size=4 + SEND_WORKERS))
+    # Never started, GithubHandler only reports errors through it
+    dispatcher = Dispatcher(bot, Queue(), use_context=True)
+    dispatcher.add_error_handler(_error_handler)
+
+    # Telegram's overall limit is shared with the other workers
+    message_scheduler = MessageScheduler(bot, workers=SEND_WORKERS,
+                                         global_rate=SEND_GLOBAL_RATE / partitions, chat_rate=SEND_CHAT_RATE)
+    executor = KeyedExecutor(workers=GITHUB_WORKERS, max_queue=GITHUB_QUEUE_SIZE)
+    github_handler = GithubHandler(dispatcher, message_scheduler, executor)
+
+    render_pool.start()
+    message_scheduler.start()
+    executor.start()
+    webhook_journal.start()
+    logger.info('Started')
+
+    # Deliveries up to this id were already handed to the executor
+    last_id = 0
+    refreshed = 0
+    try:
+        while not stop.is_set():
+            if time.monotonic() - refreshed > DELIVERY_SUBSCRIPTIONS_REFRESH:
+                # Subscriptions change in the webhook server process, which writes them out when it flushes
+                try:
+                    repo_index.rebuild_from(read_subscriptions(DATABASE_FILE))
+                except sqlite3.Error:
+                    logger.warning('Error while loading subscriptions', exc_info=1)
+                refreshed = time.monotonic()
+
+            # Those that didn't fit in the executor before, which keeps them in order with the ones claimed below
+            github_handler.retry_deferred()
+
+            deliveries = webhook_journal.claim(partition, partitions, last_id)
+            for journal_id, guid, event, body in deliveries:
+                update = GithubUpdate(json.loads(body), guid, event, journal_id=journal_id)
+                github_handler.handle_update(update, CallbackContext.from_update(update, dispatcher))
+                last_id = journal_id
+
+            if not deliveries:
+                stop.wait(DELIVERY_POLL_INTERVAL)
+    finally:
+        executor.stop()
+        message_scheduler.stop()
+        render_pool.stop()
+        # Last, so that deliveries still being handled above get marked as done
+        webhook_journal.stop()
+        logger.info('Stopped')
+
+
+class DeliveryWorkers:
+    # Processes that handle github deliveries (rendering and sending included), so that it isn't all
+    # stuck on a single core along with the webhook server. Every repository belongs to one of them.
+    def __init__(self, workers=2):
+        self.logger = logging.getLogger(self.__class__.__qualname__)
+
+        self.workers = workers
+
+        self._context = multiprocessing.get_context('spawn')
+        self._stop = self._context.Event()
+        self._processes = []
+
+    def start(self):
+        for i in range(self.workers):
+            process = self._context.Process(target=run, args=(i, self.workers, self._stop),
+                                            name=f'delivery_worker_{i}')
+            process.start()
+            self._processes.append(process)
+
+    def stop(self, timeout=30):
+        self._stop.set()
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                self.logger.warning('%s did not stop in time, terminating it', process.name)
+                process.terminate()
+                process.join()
+        self._processes = []
+
+    def alive(self):
+        return sum(process.is_alive() for process in self._processes)
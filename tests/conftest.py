@@ -0,0 +1,17 @@
+import os
+import tempfile
+
+# bot.const reads its configuration from the environment when it is imported
+_directory = tempfile.mkdtemp(prefix='githubbot-tests-')
+for name, value in {
+    'GITHUB_WEBHOOK_SECRET': 'secret',
+    'TELEGRAM_BOT_TOKEN': '123456:ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghi',
+    'SERVER_PORT': '8080',
+    'SERVER_URL_BASE': 'http://localhost:8080',
+    'GITHUB_PRIVATE_KEY_PATH': os.devnull,
+    'GITHUB_APP_ID': '1',
+    'DATABASE_FILE': os.path.join(_directory, 'bot.sqlite'),
+    'GITHUB_OAUTH_CLIENT_ID': 'client-id',
+    'GITHUB_OAUTH_CLIENT_SECRET': 'client-secret',
+}.items():
+    os.environ.setdefault(name, value)
@@ -0,0 +1,110 @@
+import time
+
+import pytest
+
+from bot.gfm import render
+
+
+def inline(markdown, context='foo/bar'):
+    html = render(markdown, context)
+    assert html.startswith('<p>') and html.endswith('</p>\n'), html
+    return html[3:-5]
+
+
+@pytest.mark.parametrize('markdown, expected', [
+    ('AT&T', 'AT&amp;T'),
+    ('&copy;', '©'),
+    ('&amp;', '&amp;'),
+    ('&lt;b&gt;', '&lt;b&gt;'),
+    ('&#65; &#x42; &#X43;', 'A B C'),
+    ('&#0;', '�'),
+    ('&bogus;', '&amp;bogus;'),
+    ('&copy', '&amp;copy'),
+    ('\\&copy;', '&amp;copy;'),
+    ('`&copy;`', '<code>&amp;copy;</code>'),
+])
+def test_character_references(markdown, expected):
+    assert inline(markdown) == expected
+
+
+def test_numeric_reference_is_not_an_issue():
+    assert inline('&#35;1') == '#1'
+
+
+@pytest.mark.parametrize('markdown, expected', [
+    ('a <b> & "quotes"', 'a <b> &amp; "quotes"'),
+    ('a < b > c', 'a &lt; b &gt; c'),
+    ('a <span x=1 y=\'2\'>', 'a <span x=1 y=\'2\'>'),
+    ('\\*not em\\*', '*not em*'),
+    ('\\<b>', '&lt;b&gt;'),
+    ('`<b> & *x*`', '<code>&lt;b&gt; &amp; *x*</code>'),
+])
+def test_escaping(markdown, expected):
+    assert inline(markdown) == expected
+
+
+@pytest.mark.parametrize('markdown, expected', [
+    ('<https://example.com/a?b=1&c=2>',
+     '<a href="https://example.com/a?b=1&amp;c=2">https://example.com/a?b=1&amp;c=2</a>'),
+    ('<foo@example.com>', '<a href="mailto:foo@example.com">foo@example.com</a>'),
+    ('see https://example.com/x_y.', 'see <a href="https://example.com/x_y">https://example.com/x_y</a>.'),
+    ('www.example.com', '<a href="http://www.example.com">www.example.com</a>'),
+    ('(https://example.com/a)', '(<a href="https://example.com/a">https://example.com/a</a>)'),
+    ('https://example.com/?a=1&b=2', '<a href="https://example.com/?a=1&amp;b=2">https://example.com/?a=1&amp;b=2</a>'),
+    ('http://x.com/"onmouseover="a',
+     '<a href="http://x.com/&quot;onmouseover=&quot;a">http://x.com/"onmouseover="a</a>'),
+    ('http://x.com/<b', '<a href="http://x.com/">http://x.com/</a>&lt;b'),
+    ('[text](http://x.com/?a=1&amp;b=2)', '<a href="http://x.com/?a=1&amp;b=2">text</a>'),
+    ('[a "b"](http://x.com/")', '<a href="http://x.com/&quot;">a "b"</a>'),
+])
+def test_links(markdown, expected):
+    assert inline(markdown) == expected
+
+
+@pytest.mark.parametrize('markdown, expected', [
+    ('@octo-cat', '<a class="user-mention" href="https://github.com/octo-cat">@octo-cat</a>'),
+    ('mail@example.com', 'mail@example.com'),
+    ('`@octo`', '<code>@octo</code>'),
+    ('#12', '<a class="issue-link" href="https://github.com/foo/bar/issues/12">#12</a>'),
+    ('a#12 &#35;12', 'a#12 #12'),
+])
+def test_mentions_and_issues(markdown, expected):
+    assert inline(markdown) == expected
+
+
+def test_issues_need_a_context():
+    assert inline('#12', context=None) == '#12'
+
+
+@pytest.mark.parametrize('markdown, expected', [
+    ('**bold** *em* __b__ _e_ ~~del~~',
+     '<strong>bold</strong> <em>em</em> <strong>b</strong> <em>e</em> <del>del</del>'),
+    ('***both***', '<em><strong>both</strong></em>'),
+    ('**a *b* c**', '<strong>a <em>b</em> c</strong>'),
+    ('*a **b** c*', '<em>a <strong>b</strong> c</em>'),
+    ('snake_case_word', 'snake_case_word'),
+    ('a * b * c', 'a * b * c'),
+    ('**unclosed', '**unclosed'),
+    ('~a~ ~~~a~~~', '~a~ ~~~a~~~'),
+    ('[*x*](http://a)', '<a href="http://a"><em>x</em></a>'),
+])
+def test_emphasis(markdown, expected):
+    assert inline(markdown) == expected
+
+
+@pytest.mark.parametrize('markdown', ['\x00', '\x001\x00', 'a \x000\x00 b'])
+def test_nul(markdown):
+    assert '\x00' not in render(markdown)
+
+
+@pytest.mark.parametrize('markdown', ['*a ' * 20000, '_a ' * 20000, '~~a ' * 5000, '`a ' * 20000])
+def test_unclosed_delimiters_are_linear(markdown):
+    start = time.monotonic()
+    render(markdown)
+    assert time.monotonic() - start < 2
+
+
+def test_deep_nesting():
+    html = render('>' * 1000 + ' x')
+    assert html.count('<blockquote>') < 1000
+    render(''.join('  ' * i + '- a\n' for i in range(1000)))
@@ -0,0 +1,111 @@
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from bot import github
+from bot.executor import KeyedExecutor
+from bot.githubupdates import GithubUpdate
+from bot.journal import WebhookJournal
+from bot.sender import MessageScheduler
+
+
+@pytest.fixture
+def journal(tmp_path, monkeypatch):
+    journal = WebhookJournal(str(tmp_path / 'journal.sqlite'))
+    journal.start()
+    monkeypatch.setattr(github, 'webhook_journal', journal)
+    yield journal
+    journal.stop()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_deferred_deliveries_keep_their_order(journal):
+    executor = KeyedExecutor(workers=2, max_queue=2)
+    executor.start()
+    handler = github.GithubHandler(mock.Mock(), mock.Mock(), executor)
+
+    gate = threading.Event()
+    handled = []
+
+    def ping(update, _):
+        gate.wait()
+        handled.append(update.journal_id)
+
+    handler.ping = ping
+
+    def deliver(repo_id):
+        payload = {'repository': {'id': repo_id, 'full_name': f'owner/{repo_id}'}}
+        journal_id = journal.append(None, 'ping', '{"repository": {"id": %d}}' % repo_id, repo_id).result()
+        handler.handle_update(GithubUpdate(payload, None, 'ping', journal_id=journal_id), mock.Mock())
+        return journal_id
+
+    try:
+        # The third doesn't fit, the ones after it wait for it
+        ids = [deliver(1) for _ in range(5)]
+        assert executor.stats()['rejected'] == 1
+        # Another repository isn't held up by that
+        other = deliver(2)
+        gate.set()
+        wait_for(lambda: other in handled)
+
+        ids.append(deliver(1))
+        while len([journal_id for journal_id in handled if journal_id != other]) < len(ids):
+            handler.retry_deferred()
+            time.sleep(0.01)
+        assert [journal_id for journal_id in handled if journal_id != other] == ids
+        assert not handler._deferred
+    finally:
+        gate.set()
+        executor.stop()
+
+
+def test_delivery_is_done_once_its_messages_are_sent(journal, monkeypatch):
+    sent = []
+
+    class Bot:
+        def send_message(self, chat_id, text, **kwargs):
+            if text == 'bad':
+                # Not a TelegramError
+                raise ValueError(text)
+            sent.append((chat_id, text))
+
+    scheduler = MessageScheduler(Bot(), workers=1, global_rate=1000, chat_rate=1000)
+    executor = KeyedExecutor(workers=1)
+    handler = github.GithubHandler(mock.Mock(), scheduler, executor)
+    monkeypatch.setattr(github.repo_index, 'targets', lambda repo_id, settings: [(10, 4096), (11, 4096)])
+    monkeypatch.setattr(github.render_pool, 'truncate_many', lambda tokens, *args: {4096: text})
+
+    def ping(update, _):
+        handler._send({'id': 1}, 'ping', 1)
+
+    handler.ping = ping
+
+    text = 'bad'
+    journal_id = journal.append(None, 'ping', '{}', 1).result()
+    handler.handle_update(GithubUpdate({'repository': {'id': 1}}, None, 'ping', journal_id=journal_id), None)
+    executor.start()
+    executor.stop()
+    # Queued, but not sent yet
+    time.sleep(0.1)
+    assert journal.unfinished(1, 0)
+
+    scheduler.start()
+    try:
+        wait_for(lambda: not journal.unfinished(1, 0))
+        assert scheduler.stats()['failed'] == 2
+
+        # The scheduler still serves those chats
+        text = 'good'
+        handler._send({'id': 1}, 'ping', 1)
+        wait_for(lambda: len(sent) == 2)
+        assert sorted(sent) == [(10, 'good'), (11, 'good')]
+    finally:
+        scheduler.stop()
@@ -0,0 +1,62 @@
+import asyncio
+import json
+import threading
+import time
+from unittest import mock
+
+from bot.asyncgithubapi import AsyncGithubAPI
+from bot.githubapi import GithubAPI
+
+EXPIRES_AT = '2099-01-01T00:00:00Z'
+
+
+def test_installation_tokens_are_minted_once_per_installation():
+    api = GithubAPI()
+    minted = []
+
+    def post(url, **kwargs):
+        installation_id = url.split('/')[-2]
+        minted.append(installation_id)
+        # Installation 1 is slow, which mustn't hold up installation 2
+        time.sleep(0.3 if installation_id == '1' else 0.01)
+        return mock.Mock(json=lambda: {'token': f'token{installation_id}', 'expires_at': EXPIRES_AT})
+
+    tokens = {}
+
+    def get(installation_id):
+        token = api.get_installation_access_token(installation_id)
+        tokens.setdefault(installation_id, []).append((token, time.monotonic()))
+
+    with mock.patch.object(api, 'post', side_effect=post):
+        start = time.monotonic()
+        threads = [threading.Thread(target=get, args=(installation_id,)) for installation_id in (1, 1, 1, 2, 2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert sorted(minted) == ['1', '2']
+    assert {token for token, _ in tokens[1]} == {'token1'}
+    assert all(at - start < 0.2 for _, at in tokens[2])
+
+
+def test_async_installation_tokens_are_minted_once_and_shared():
+    api = GithubAPI()
+    async_api = AsyncGithubAPI(api)
+    minted = []
+
+    async def fetch(method, url, **kwargs):
+        minted.append(url)
+        await asyncio.sleep(0.05)
+        return mock.Mock(body=json.dumps({'token': 'async-token', 'expires_at': EXPIRES_AT}).encode())
+
+    async def get_many():
+        return await asyncio.gather(*[async_api.get_installation_access_token(3) for _ in range(5)])
+
+    with mock.patch.object(async_api, 'fetch', side_effect=fetch):
+        assert asyncio.run(get_many()) == ['async-token'] * 5
+
+    assert len(minted) == 1
+    # The blocking client uses the same token
+    with mock.patch.object(api, 'post', side_effect=AssertionError('minted again')):
+        assert api.get_installation_access_token(3) == 'async-token'
@@ -0,0 +1,34 @@
+import random
+
+import pytest
+
+from bot import gfm
+from bot.github import REPLY_MESSAGE, REPLY_MESSAGE_TOKENS, TRUNCATED_MESSAGE, TRUNCATED_MESSAGE_TOKENS
+from bot.truncator import clean_tokens, github_cleaner, parse_fragment, truncate, truncate_many
+
+LIMITS = [256, 512, 1024, 2048, 4096]
+HEADER = 'header <a href="https://example.com">link</a>\n\n'
+WORDS = ['foo', '**bold**', '`code`', '[l](http://x.y/a&b?c=1&amp;d="2")', 'a<b', '&amp;', '&lt;', '&copy;',
+         '&bogus;', '\n', '\n\n', '- item\n', '- [x] t\n', '> q\n', '*em*', 'x' * 50, '<img src=x>', '<!-- c -->',
+         '<script>x</script>', '\n```suggestion\nfoo\n```\n', '\n```\n\nfoo\n```\n',
+         '<details><summary>s</summary>d</details>']
+
+
+def corpus(size=100):
+    rng = random.Random(2)
+    for _ in range(size):
+        html = gfm.render(' '.join(rng.choice(WORDS) for _ in range(rng.randint(0, 300))), 'foo/bar')
+        if rng.random() < 0.1:
+            html = f'\n\n{html}\n\n'
+        yield html
+
+
+@pytest.mark.parametrize('html', list(corpus()))
+def test_truncate_many_of_tokens_matches_clean_then_truncate(html):
+    # What _send did before it was handed the cleaned tokens
+    cleaned = github_cleaner.clean(html).strip('\n')
+    expected = {limit: truncate(HEADER + cleaned, TRUNCATED_MESSAGE, REPLY_MESSAGE, max_length=limit)
+                for limit in LIMITS}
+
+    tokens = parse_fragment(HEADER) + clean_tokens(html)
+    assert truncate_many(tokens, TRUNCATED_MESSAGE_TOKENS, REPLY_MESSAGE_TOKENS, LIMITS) == expected